@@ -6,41 +6,1044 @@ IMPORTS
 
 import pyspark
 import findspark
-from pyspark import SparkContext
+from pyspark import SparkConf, SparkContext, StorageLevel, inheritable_thread_target
 from pyspark.sql import SparkSession
 from pyspark.sql.types import * 
 from pyspark.sql.functions import *
-from pyspark.ml.feature import VectorAssembler
-from pyspark.ml.feature import StringIndexer
-from pyspark.ml.feature import MinMaxScaler
+from pyspark.ml import Pipeline
+from pyspark.ml.feature import VectorAssembler, SQLTransformer
+from pyspark.ml.feature import StringIndexer, StringIndexerModel
+from pyspark.ml.feature import MinMaxScaler, MinMaxScalerModel
 from pyspark.ml.stat import Correlation
+from pyspark.ml.functions import vector_to_array
 from pyspark.ml.regression import *
 from pyspark.ml.evaluation import *
-from pyspark.ml.tuning import CrossValidator, ParamGridBuilder
+from pyspark.ml.tuning import ParamGridBuilder
+import os
+import json
+import csv
+import builtins
+import math
+import sys
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import reduce
+import shutil
+import tempfile
+import hashlib
+
+"""
+===========================================
+REGRESSOR REGISTRY
+===========================================
+"""
+
+# The AutoML trains every regressor of the registry. Each candidate declares its estimator, its hyperparameter grid,
+# its search space (for Hyperband and TPE), its cost class and the resources it needs (the weight and the minimum
+# share of cores of its scheduler pool). The cheap candidates are scheduled first and, by default, get a larger weight
+# and a minimum share of cores, so they finish while the expensive ones are still training.
+# A new regressor is added by registering a new candidate, without changes to the AutoML module.
+
+# Cost classes: name -> (order of scheduling, weight of the pool, minimum share of cores)
+classes_custo = {'barato': (0, 2, 1), 'medio': (1, 1, 0), 'caro': (2, 1, 0)}
+
+# Candidate regressor of the AutoML
+# criar_estimador returns a new estimator, grade returns its hyperparameter grid, configurar (optional) adjusts the
+# estimator before the search, iteracoes (optional) returns the number of iterations used by the best model, and
+# modelo_base also trains and evaluates a version without cross validation for reference.
+# The search space is a dict of domains (see func_amostrar_valor) and the budget of Hyperband is (resource, minimum, maximum).
+class CandidatoRegressor:
+
+    def __init__(self, nome, titulo, criar_estimador, grade, custo, espaco = None, recurso = None, peso_pool = None, minimo_pool = None,
+                 configurar = None, iteracoes = None, modelo_base = False):
+        self.nome = nome
+        self.titulo = titulo
+        self.criar_estimador = criar_estimador
+        self.grade = grade
+        self.custo = custo
+        self.espaco = espaco
+        self.recurso = recurso
+        self.peso_pool = peso_pool if peso_pool is not None else classes_custo[custo][1]
+        self.minimo_pool = minimo_pool if minimo_pool is not None else classes_custo[custo][2]
+        self.configurar = configurar
+        self.iteracoes = iteracoes
+        self.modelo_base = modelo_base
+
+# Registry of the candidates (name -> candidate)
+candidatos_regressores = {}
+
+# Function to register a candidate
+def func_registrar_regressor(candidato):
+    candidatos_regressores[candidato.nome] = candidato
+    return candidato
+
+# Candidates ordered by cost class (the cheap ones first, keeping the order of registration within each class)
+def func_ordenar_candidatos(candidatos):
+    return sorted(candidatos, key = lambda candidato: classes_custo[candidato.custo][0])
+
+func_registrar_regressor(CandidatoRegressor(
+    'LinearRegression', "Linear Regression Model", LinearRegression,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.regParam, [0.1, 0.01]).build(), 'barato',
+    espaco = {'regParam': ('log', 1e-4, 1.0), 'elasticNetParam': ('float', 0.0, 1.0)},
+    recurso = ('fracao_dados', 1.0 / 9, 1.0), modelo_base = True))
+
+func_registrar_regressor(CandidatoRegressor(
+    'DecisionTreeRegressor', "Decision Tree Model", DecisionTreeRegressor,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.maxBins, [10, 20, 40]).build(), 'medio',
+    espaco = {'maxDepth': ('int', 2, 15), 'maxBins': [10, 20, 40, 80], 'minInstancesPerNode': ('int', 1, 20)},
+    recurso = ('fracao_dados', 1.0 / 9, 1.0)))
+
+func_registrar_regressor(CandidatoRegressor(
+    'RandomForestRegressor', "RandomForest Model", RandomForestRegressor,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.numTrees, [5, 20]).build(), 'caro',
+    espaco = {'maxDepth': ('int', 3, 12), 'maxBins': [16, 32, 64], 'subsamplingRate': ('float', 0.5, 1.0),
+              'featureSubsetStrategy': ['auto', 'sqrt', 'onethird', 'all']},
+    recurso = ('numTrees', 5, 45)))
+
+# GBT stops early on the rows of the validation indicator (see GBT EARLY STOPPING)
+func_registrar_regressor(CandidatoRegressor(
+    'GBTRegressor', "Gradient-Boosted Tree (GBT) Model", GBTRegressor,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.maxBins, [10, 20]).addGrid(estimador.maxIter, [10, 15]).build(), 'caro',
+    espaco = {'maxDepth': ('int', 2, 8), 'maxBins': [16, 32, 64], 'stepSize': ('log', 0.01, 0.3), 'subsamplingRate': ('float', 0.5, 1.0)},
+    recurso = ('maxIter', 5, 45),
+    configurar = lambda estimador: estimador.setValidationIndicatorCol(coluna_validacao_gbt).setValidationTol(tolerancia_gbt) if parada_antecipada_gbt else None,
+    iteracoes = lambda modelo: modelo.getNumTrees))
+
+func_registrar_regressor(CandidatoRegressor(
+    'IsotonicRegression', "Isotonic Model", IsotonicRegression,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.isotonic, [True, False]).build(), 'barato',
+    espaco = {'isotonic': [True, False]},
+    recurso = ('fracao_dados', 1.0 / 3, 1.0)))
+
+func_registrar_regressor(CandidatoRegressor(
+    'GeneralizedLinearRegression', "Generalized Linear Model", GeneralizedLinearRegression,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.regParam, [0.0, 0.1]).build(), 'barato'))
+
+func_registrar_regressor(CandidatoRegressor(
+    'FMRegressor', "Factorization Machines Model", FMRegressor,
+    lambda estimador: ParamGridBuilder().addGrid(estimador.factorSize, [4, 8]).build(), 'medio'))
+
+# The AFT survival regression needs a censor column: every strength is observed, so the censor is always 1.0
+func_registrar_regressor(CandidatoRegressor(
+    'AFTSurvivalRegression', "Accelerated Failure Time (AFT) Model",
+    lambda: Pipeline(stages = [SQLTransformer(statement = "SELECT *, 1.0 AS censura FROM __THIS__"), AFTSurvivalRegression(censorCol = 'censura')]),
+    lambda estimador: ParamGridBuilder().addGrid(estimador.getStages()[-1].maxIter, [50, 100]).build(), 'barato'))
 
 # Preparing the Spark Environment
-# Creating the Spark Context
-sc = SparkContext(appName = "Project-14")
+
+# The regressors are trained concurrently, each one in its own FAIR scheduler pool.
+# Pools of the regressors: name -> (weight, minimum share of cores), as declared by the candidates
+pools_regressores = {candidato.nome: (candidato.peso_pool, candidato.minimo_pool) for candidato in candidatos_regressores.values()}
+
+# Allocation file of the FAIR scheduler (generated at each run, in a temporary directory outside the project)
+caminho_pools = os.path.join(tempfile.mkdtemp(prefix = 'project14_'), 'fairscheduler.xml')
+
+# Function to write the allocation file with the pools of the regressors
+def func_escrever_pools(pools, caminho):
+    os.makedirs(os.path.dirname(caminho), exist_ok = True)
+    with open(caminho, 'w') as arquivo:
+        arquivo.write('<?xml version="1.0"?>\n<allocations>\n')
+        for nome, (peso, minimo) in pools.items():
+            arquivo.write('  <pool name="' + nome + '">\n    <schedulingMode>FIFO</schedulingMode>\n    <weight>' + str(peso) + '</weight>\n    <minShare>' + str(minimo) + '</minShare>\n  </pool>\n')
+        arquivo.write('</allocations>\n')
+
+func_escrever_pools(pools_regressores, caminho_pools)
+
+# Creating the Spark Context (with the FAIR scheduler)
+conf = SparkConf().setAppName("Project-14").set("spark.scheduler.mode", "FAIR").set("spark.scheduler.allocation.file", caminho_pools)
+sc = SparkContext(conf = conf)
 sc.setLogLevel("ERROR")
 
 # Creating the session
 spark = SparkSession.builder.getOrCreate()
 
+"""
+===========================================
+RUN MODE
+===========================================
+"""
+
+# In the exploratory mode (default) the script shows the data at each step, as in a notebook.
+# In production, every show, count and toPandas used only for display is a full Spark job.
+# The production mode ("quiet mode") skips these actions and reports how many jobs it saved.
+# Set the environment variable PROJECT14_MODO=producao to enable it.
+modo_execucao = os.environ.get('PROJECT14_MODO', 'exploratorio')
+modo_silencioso = modo_execucao == 'producao'
+
+# Spark jobs skipped by the quiet mode, by action
+jobs_economizados = {}
+
+# Function to run an action that is only used to display data
+def func_acao_exploratoria(descricao, acao, num_jobs = 1):
+
+    # In the quiet mode we skip the action and count the jobs it would have triggered
+    if modo_silencioso:
+        jobs_economizados[descricao] = jobs_economizados.get(descricao, 0) + num_jobs
+        return None
+
+    return acao()
+
+# Function to report the jobs saved by the quiet mode
+def func_relatorio_modo_silencioso():
+    if not modo_silencioso:
+        return
+    print('\033[1m' + "Quiet Mode Report:" + '\033[0m')
+    for descricao, num_jobs in jobs_economizados.items():
+        print(descricao + ':', num_jobs, 'job(s) skipped')
+    print('Total of Spark jobs saved:', builtins.sum(jobs_economizados.values()))
+
+"""
+===========================================
+CACHE MANAGER
+===========================================
+"""
+
+# Without persistence, every action (counts, quantile jobs, the correlation and each of the cross-validation fits)
+# recomputes the dataframes from the source. The cache manager persists the intermediate dataframes
+# at a configurable storage level and unpersists each one as soon as the last stage that consumes it is done.
+# It also reports the cache hit rate and the memory and disk in use.
+
+# Storage levels available
+niveis_armazenamento = {'memoria': StorageLevel.MEMORY_ONLY,
+                        'memoria_disco': StorageLevel.MEMORY_AND_DISK,
+                        'serializado': StorageLevel(True, True, False, False),
+                        'disco': StorageLevel.DISK_ONLY}
+
+# Default storage level (PROJECT14_NIVEL_CACHE=memoria|memoria_disco|serializado|disco)
+nivel_cache_padrao = os.environ.get('PROJECT14_NIVEL_CACHE', 'memoria_disco')
+
+class GerenciadorCache:
+
+    def __init__(self, nivel_padrao = nivel_cache_padrao):
+        self.nivel_padrao = nivel_padrao
+
+        # Persisted dataframes: name -> {df, consumers, level, materialized, checkpoint}
+        self.entradas = {}
+
+        # Accesses to the persisted dataframes (the regressors are trained in several threads)
+        # The hits are measured by Spark: each access counts the fraction of the partitions found in the cache
+        # (the local checkpoints are not in the cache manager of Spark, so their accesses are not measured)
+        self.acessos = 0
+        self.acertos = 0.0
+        self.acessos_nao_medidos = 0
+        self.lock = threading.Lock()
+
+    # Persist a dataframe until every consumer stage is done
+    # With a checkpoint mode ('confiavel' or 'local'), the lineage is truncated after the dataframe is persisted
+    def persistir(self, nome, df, consumidores, nivel = None, materializar = False, checkpoint = 'nenhum'):
+        nivel = self.nivel_padrao if nivel is None else nivel
+        if nome in self.entradas:
+            self.liberar(nome)
+        df = df.persist(niveis_armazenamento[nivel])
+
+        # The checkpoint reads the persisted data, so the plan is computed only once
+        if checkpoint != 'nenhum':
+            df_checkpoint = func_checkpoint(df, checkpoint)
+
+            # The reliable checkpoint is read back from files, so we keep it in the cache
+            # (the local checkpoint is already kept in the block storage of the executors)
+            if checkpoint == 'confiavel':
+                df_checkpoint = df_checkpoint.persist(niveis_armazenamento[nivel])
+                df_checkpoint.count()
+            df.unpersist()
+            df = df_checkpoint
+
+        self.entradas[nome] = {'df': df, 'consumidores': set(consumidores), 'nivel': nivel, 'materializado': checkpoint != 'nenhum', 'checkpoint': checkpoint}
+
+        # Materialize now (one job), so the next consumers already read from the cache
+        if materializar and not self.entradas[nome]['materializado']:
+            df.count()
+            self.entradas[nome]['materializado'] = True
+
+        return df
+
+    # Fraction of the partitions of a persisted dataframe that are in the cache, from the storage info of Spark
+    # (None if the dataframe is not in the cache manager of Spark)
+    def fracao_em_cache(self, df):
+        dados_cache = spark._jsparkSession.sharedState().cacheManager().lookupCachedData(df._jdf)
+        if dados_cache.isEmpty():
+            return None
+        id_rdd = dados_cache.get().cachedRepresentation().cacheBuilder().cachedColumnBuffers().id()
+        for info in spark.sparkContext._jsc.sc().getRDDStorageInfo():
+            if info.id() == id_rdd:
+                return float(info.numCachedPartitions()) / info.numPartitions() if info.numPartitions() > 0 else 0.0
+        return 0.0
+
+    # Get a persisted dataframe (a hit when its partitions are in the cache: evicted blocks count as misses)
+    def obter(self, nome):
+        with self.lock:
+            entrada = self.entradas[nome]
+            self.acessos += 1
+            fracao = self.fracao_em_cache(entrada['df'])
+            if fracao is None:
+                self.acessos_nao_medidos += 1
+            else:
+                self.acertos += fracao
+            entrada['materializado'] = True
+            return entrada['df']
+
+    # Unpersist a dataframe (and release the data of its checkpoint)
+    def liberar(self, nome):
+        entrada = self.entradas.pop(nome)
+        entrada['df'].unpersist()
+        func_liberar_checkpoint(entrada['df'], entrada['checkpoint'])
+        print("\nCache released: " + nome)
+
+    # A stage is done: the dataframes with no consumers left are unpersisted
+    def concluir(self, estagio):
+        for nome in list(self.entradas):
+            self.entradas[nome]['consumidores'].discard(estagio)
+            if len(self.entradas[nome]['consumidores']) == 0:
+                self.liberar(nome)
+
+    # Report of the hit rate and of the memory and disk in use
+    def relatorio(self):
+        armazenamento = spark.sparkContext._jsc.sc().getRDDStorageInfo()
+        memoria = builtins.sum(info.memSize() for info in armazenamento)
+        disco = builtins.sum(info.diskSize() for info in armazenamento)
+        print('\033[1m' + "Cache Report:" + '\033[0m')
+        print('Persisted dataframes:', {nome: entrada['nivel'] for nome, entrada in self.entradas.items()})
+        acessos_medidos = self.acessos - self.acessos_nao_medidos
+        print('Accesses:', self.acessos, '- Hits:', self.acertos, '- Hit rate:', self.acertos / acessos_medidos if acessos_medidos > 0 else None,
+              '- Accesses not measured (local checkpoints):', self.acessos_nao_medidos)
+        print('Memory in use (MB):', memoria / 1024.0 ** 2, '- Disk in use (MB):', disco / 1024.0 ** 2)
+
+# Cache manager of the run
+gerenciador_cache = GerenciadorCache()
+
+"""
+===========================================
+CHECKPOINTS
+===========================================
+"""
+
+# The plan of the prepared data goes from the read of the source to the scaling, and the split and every
+# cross-validation fold evaluate it again. A checkpoint truncates the lineage, so the model fitting starts
+# from a short plan and the loss of an executor does not trigger the full recomputation.
+# - confiavel: reliable checkpoint, written to the checkpoint directory (survives the loss of executors)
+# - local: local checkpoint, kept in the executors' block storage (faster, but not fault tolerant)
+# - nenhum: no checkpoint
+# Set the environment variable PROJECT14_CHECKPOINT to choose the mode.
+modo_checkpoint = os.environ.get('PROJECT14_CHECKPOINT', 'nenhum')
+
+# Directory of the reliable checkpoints
+diretorio_checkpoint = 'dados/checkpoints'
+if modo_checkpoint == 'confiavel':
+    sc.setCheckpointDir(diretorio_checkpoint)
+
+# Function to checkpoint a dataframe (eager, so the lineage is truncated right away)
+def func_checkpoint(df, modo = modo_checkpoint):
+    if modo == 'confiavel':
+        return df.checkpoint(eager = True)
+    if modo == 'local':
+        return df.localCheckpoint(eager = True)
+    if modo == 'nenhum':
+        return df
+    raise ValueError("Unknown checkpoint mode: " + str(modo) + ". Use 'confiavel', 'local' or 'nenhum'.")
+
+# Function to release the data of a checkpointed dataframe. The unpersist of the dataframe doesn't reach it:
+# the local checkpoint keeps the checkpointed RDD in the block storage of the executors, and the reliable checkpoint
+# writes it to files in the checkpoint directory, so both are released explicitly
+def func_liberar_checkpoint(df, modo = modo_checkpoint):
+    if modo == 'nenhum':
+        return
+
+    # The plan of a checkpointed dataframe is a scan of the checkpointed RDD
+    rdd_checkpoint = df._jdf.logicalPlan().rdd()
+    rdd_checkpoint.unpersist(False)
+    if modo == 'confiavel':
+        caminho = sc._jvm.org.apache.hadoop.fs.Path(sc._jsc.sc().getCheckpointDir().get(), 'rdd-' + str(rdd_checkpoint.id()))
+        caminho.getFileSystem(sc._jsc.hadoopConfiguration()).delete(caminho, True)
+
+"""
+===========================================
+SCHEMA REGISTRY
+===========================================
+"""
+
+# Reading the CSV with inferSchema = True scans the whole file twice: once to infer the types and once to load it.
+# Instead, we keep a versioned registry of declared schemas and load the data in a single scan.
+# A new dataset (or a new version of an existing one) can have its schema generated once from a sample and saved as JSON.
+
+# Path of the dataset
+caminho_dados = 'dados/dataset.csv'
+
+# Directory where generated schemas are saved
+diretorio_schemas = 'dados/schemas'
+
+# Registry of declared schemas, keyed by (dataset name, version)
+registro_schemas = {
+    ('concrete', 1): StructType([
+        StructField('cement', DoubleType(), True),
+        StructField('slag', DoubleType(), True),
+        StructField('flyash', DoubleType(), True),
+        StructField('water', DoubleType(), True),
+        StructField('superplasticizer', DoubleType(), True),
+        StructField('coarseaggregate', DoubleType(), True),
+        StructField('fineaggregate', DoubleType(), True),
+        StructField('age', IntegerType(), True),
+        StructField('csMPa', DoubleType(), True)
+    ])
+}
+
+# Function to generate a schema once from a sample of the file and save it in the registry
+def func_gerar_schema(caminho, nome, versao, fracao_amostra = 0.1):
+
+    # Infer the types reading only a fraction of the rows
+    schema = spark.read.csv(caminho, inferSchema = True, header = True, samplingRatio = fracao_amostra).schema
+
+    # Save the schema as JSON so the next runs don't need to infer it again
+    os.makedirs(diretorio_schemas, exist_ok = True)
+    with open(os.path.join(diretorio_schemas, nome + '_v' + str(versao) + '.json'), 'w') as arquivo:
+        arquivo.write(schema.json())
+
+    # Register the schema
+    registro_schemas[(nome, versao)] = schema
+
+    return schema
+
+# Function to get a schema from the registry (latest version if none is given)
+def func_obter_schema(nome, versao = None):
+
+    # Load the schemas saved as JSON that are not yet in the registry
+    if os.path.isdir(diretorio_schemas):
+        for nome_arquivo in os.listdir(diretorio_schemas):
+            nome_schema, _, sufixo = nome_arquivo[:-len('.json')].rpartition('_v')
+            if nome_arquivo.endswith('.json') and nome_schema == nome and sufixo.isdigit() and (nome, int(sufixo)) not in registro_schemas:
+                with open(os.path.join(diretorio_schemas, nome_arquivo)) as arquivo:
+                    registro_schemas[(nome, int(sufixo))] = StructType.fromJson(json.load(arquivo))
+
+    # Available versions of the dataset
+    versoes = sorted(v for (n, v) in registro_schemas if n == nome)
+
+    if len(versoes) == 0:
+        raise ValueError("There is no schema registered for the dataset " + nome + ". Use func_gerar_schema to generate one.")
+
+    if versao is None:
+        versao = versoes[-1]
+    elif versao not in versoes:
+        raise ValueError("Version " + str(versao) + " of the schema " + nome + " is not registered. Available versions: " + str(versoes))
+
+    return registro_schemas[(nome, versao)]
+
+# Function to check that the file matches the schema before loading it
+def func_validar_schema(caminho, schema):
+
+    # Read only the header line (Spark reads just the first partition)
+    cabecalho = spark.read.text(caminho).first()[0]
+    colunas_arquivo = [coluna.strip().strip('"') for coluna in cabecalho.split(',')]
+
+    # Compare the columns of the file with the columns of the schema
+    if colunas_arquivo != schema.fieldNames():
+        faltantes = [coluna for coluna in schema.fieldNames() if coluna not in colunas_arquivo]
+        extras = [coluna for coluna in colunas_arquivo if coluna not in schema.fieldNames()]
+        raise ValueError("The file " + caminho + " does not match the schema. Missing columns: " + str(faltantes) + ". Unexpected columns: " + str(extras) + ". File columns: " + str(colunas_arquivo))
+
+# Function to load the data with the declared schema in a single scan
+def func_carregar_dados(caminho, nome, versao = None):
+
+    # Get the schema and validate the header of the file
+    schema = func_obter_schema(nome, versao)
+    func_validar_schema(caminho, schema)
+
+    # FAILFAST makes the load fail on the first value that does not match the declared types
+    return spark.read.csv(caminho, schema = schema, header = True, mode = 'FAILFAST')
+
+"""
+===========================================
+PARQUET CACHE OF THE RAW DATA
+===========================================
+"""
+
+# Parsing the CSV text is the largest fixed cost of each run.
+# The first time a file is seen, we convert it to a columnar Parquet copy and the next runs read that copy instead.
+# The cache is keyed by the size, the modification time and the content hash of the file (and by the schema used to read it).
+
+# Directory of the Parquet cache
+diretorio_cache = 'dados/cache'
+
+# Number of Parquet files written for each cached dataset
+num_particoes_cache = 8
+
+# Function to compute the SHA-256 of a file reading it in blocks
+def func_hash_arquivo(caminho, tamanho_bloco = 1 << 20):
+    sha256 = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(tamanho_bloco), b''):
+            sha256.update(bloco)
+    return sha256.hexdigest()
+
+# Function to load the data from the Parquet cache, converting the CSV only when it changed
+def func_carregar_dados_com_cache(caminho, nome, versao = None, colunas = None, coluna_particao = None):
+
+    # Schema used to read the CSV (a new schema version also invalidates the cache)
+    schema = func_obter_schema(nome, versao)
+
+    # Manifest with the fingerprint of the file that generated the current cache
+    diretorio = os.path.join(diretorio_cache, nome)
+    caminho_manifesto = os.path.join(diretorio, 'manifest.json')
+    manifesto = None
+    if os.path.exists(caminho_manifesto):
+        with open(caminho_manifesto) as arquivo:
+            manifesto = json.load(arquivo)
+
+    # Size and modification time are cheap to check, the content hash is computed only when they changed
+    estatisticas = os.stat(caminho)
+    fingerprint = {'tamanho': estatisticas.st_size, 'mtime': estatisticas.st_mtime, 'schema': schema.json()}
+
+    cache_valido = False
+    if manifesto is not None and os.path.exists(os.path.join(manifesto['caminho_parquet'], '_SUCCESS')):
+        if all(manifesto[chave] == fingerprint[chave] for chave in fingerprint):
+            cache_valido = True
+        elif manifesto['tamanho'] == fingerprint['tamanho'] and manifesto['schema'] == fingerprint['schema']:
+            fingerprint['sha256'] = func_hash_arquivo(caminho)
+            cache_valido = manifesto['sha256'] == fingerprint['sha256']
+
+    if cache_valido:
+        print("\nReading " + caminho + " from the Parquet cache " + manifesto['caminho_parquet'])
+
+        # The file was only touched, so we keep the cache and update the modification time
+        if manifesto['mtime'] != fingerprint['mtime']:
+            manifesto['mtime'] = fingerprint['mtime']
+            with open(caminho_manifesto, 'w') as arquivo:
+                json.dump(manifesto, arquivo)
+
+    else:
+        print("\nConverting " + caminho + " to the Parquet cache...")
+
+        # Content hash of the new file
+        if 'sha256' not in fingerprint:
+            fingerprint['sha256'] = func_hash_arquivo(caminho)
+
+        # Convert the CSV (single scan with the declared schema) and write the columnar copy
+        caminho_parquet = os.path.join(diretorio, fingerprint['sha256'][:16])
+        escritor = func_carregar_dados(caminho, nome, versao).repartition(num_particoes_cache).write.mode('overwrite')
+        if coluna_particao is not None:
+            escritor = escritor.partitionBy(coluna_particao)
+        escritor.parquet(caminho_parquet)
+
+        # Remove the copy generated by the previous version of the file
+        if manifesto is not None and manifesto['caminho_parquet'] != caminho_parquet:
+            shutil.rmtree(manifesto['caminho_parquet'], ignore_errors = True)
+
+        # Save the manifest
+        manifesto = dict(fingerprint, caminho_parquet = caminho_parquet)
+        with open(caminho_manifesto, 'w') as arquivo:
+            json.dump(manifesto, arquivo)
+
+    # Read the columnar copy, keeping only the requested columns (column pruning)
+    df = spark.read.parquet(manifesto['caminho_parquet'])
+    if colunas is not None:
+        df = df.select(colunas)
+
+    return df
+
 # Load the data
-dados = spark.read.csv('dados/dataset.csv', inferSchema = True, header = True)
+dados = func_carregar_dados_com_cache(caminho_dados, 'concrete')
+
+# Persist the data until the profile and the data preparation are done
+dados = gerenciador_cache.persistir('dados', dados, ['perfil', 'prep'])
 type(dados)
 
+"""
+===========================================
+DATASET PROFILER
+===========================================
+"""
+
+# Counting the rows, dropping the nulls, counting again and then scanning again for quantiles and skewness
+# costs one Spark job per question. The profiler answers all of them in a single aggregation job
+# and returns a profile object that the next stages reuse instead of scanning the data again.
+
+# Probabilities of the quantiles used to clip the outliers
+probabilidades_outliers = [0.01, 0.99]
+
+# Options of the quantile estimation (see the quantile benchmark below):
+# - erro_relativo: relative error of the sketch (0 is exact, larger values are faster and less precise)
+# - tipo_sketch: 'gk' (Spark's approxQuantile), 'kll' (mergeable sketch) or 'exato'
+# - fracao_amostra: fraction of the rows used to estimate the quantiles
+configuracao_quantis = {'erro_relativo': 0.01, 'tipo_sketch': 'gk', 'fracao_amostra': 1.0}
+
+# Profile of a dataframe: number of rows and statistics of each column
+class PerfilDados:
+
+    def __init__(self, num_linhas, num_linhas_completas, estatisticas, probabilidades):
+
+        # Total number of rows and number of rows without missing values
+        self.num_linhas = num_linhas
+        self.num_linhas_completas = num_linhas_completas
+
+        # Dictionary column -> statistics (nulos, minimo, maximo, media, variancia, assimetria, quantis)
+        self.estatisticas = estatisticas
+
+        # Probabilities of the approximate quantiles
+        self.probabilidades = probabilidades
+
+    # Approximate quantiles of a numeric column, in the order of the probabilities
+    def quantis(self, coluna):
+        return self.estatisticas[coluna]['quantis']
+
+    # Skewness of a numeric column
+    def assimetria(self, coluna):
+        return self.estatisticas[coluna]['assimetria']
+
+    # Print the profile
+    def mostrar(self):
+        print('Number of rows:', self.num_linhas)
+        print('Number of rows without missing values:', self.num_linhas_completas)
+        for coluna, estatisticas in self.estatisticas.items():
+            print(coluna + ':', estatisticas)
+
+# Profiling function (a single aggregation job)
+# The quantiles follow configuracao_quantis: with 'gk' on all the rows or 'exato' they are computed in the same
+# aggregation; with 'kll' or a sampling fraction they come from func_quantis (one more job)
+def func_perfil_dados(df, probabilidades = probabilidades_outliers, erro_relativo = None):
+
+    # Numeric columns get the full statistics, the other columns only nulls, min and max
+    colunas_numericas = [campo.name for campo in df.schema.fields if isinstance(campo.dataType, NumericType)]
+
+    # Accuracy of percentile_approx (the relative error of the quantiles is 1 / accuracy)
+    erro_relativo = configuracao_quantis['erro_relativo'] if erro_relativo is None else erro_relativo
+    precisao = builtins.max(1, int(1.0 / erro_relativo)) if erro_relativo > 0 else None
+
+    # Quantiles computed in the aggregation, or with the other options of the configuration
+    tipo_sketch = configuracao_quantis['tipo_sketch']
+    if tipo_sketch not in ('gk', 'kll', 'exato'):
+        raise ValueError("Unknown sketch type: " + str(tipo_sketch) + ". Use 'gk', 'kll' or 'exato'.")
+    quantis_na_agregacao = tipo_sketch == 'exato' or (tipo_sketch == 'gk' and configuracao_quantis['fracao_amostra'] >= 1.0)
+
+    # Row count and count of rows without missing values (what dados.na.drop() would keep)
+    linha_completa = reduce(lambda a, b: a & b, [col(coluna).isNotNull() for coluna in df.columns])
+    expressoes = [count(lit(1)), sum(when(linha_completa, 1).otherwise(0))]
+    nomes = [('num_linhas', None), ('num_linhas_completas', None)]
+
+    # Statistics of each column
+    for coluna in df.columns:
+        expressoes += [sum(col(coluna).isNull().cast('long')), min(coluna), max(coluna)]
+        nomes += [(coluna, 'nulos'), (coluna, 'minimo'), (coluna, 'maximo')]
+        if coluna in colunas_numericas:
+            expressoes += [mean(coluna), var_samp(coluna), skewness(coluna)]
+            nomes += [(coluna, 'media'), (coluna, 'variancia'), (coluna, 'assimetria')]
+            if quantis_na_agregacao:
+                if precisao is None or tipo_sketch == 'exato':
+                    expressoes.append(expr('percentile(`' + coluna + '`, array(' + ', '.join(str(p) for p in probabilidades) + '))'))
+                else:
+                    expressoes.append(percentile_approx(coluna, probabilidades, precisao))
+                nomes.append((coluna, 'quantis'))
+
+    # Run the aggregation
+    linha = df.agg(*expressoes).collect()[0]
+
+    # Organize the result by column
+    estatisticas = {coluna: {} for coluna in df.columns}
+    for (coluna, estatistica), valor in zip(nomes[2:], linha[2:]):
+        estatisticas[coluna][estatistica] = list(valor) if estatistica == 'quantis' else valor
+
+    # Quantiles with the KLL sketch or on a sample of the rows
+    if not quantis_na_agregacao and len(colunas_numericas) != 0:
+        for coluna, quantis in func_quantis(df, colunas_numericas, probabilidades, erro_relativo = erro_relativo).items():
+            estatisticas[coluna]['quantis'] = list(quantis)
+
+    return PerfilDados(linha[0], linha[1], estatisticas, list(probabilidades))
+
+"""
+===========================================
+INCREMENTAL STATISTICS (MERGEABLE SKETCHES)
+===========================================
+"""
+
+# The lab results are append-only and grow every day, so scanning the full history at each retrain
+# to get quantiles, skewness and min/max becomes the dominant cost.
+# We keep, for each column, mergeable sketches (central moments plus a KLL quantile sketch) stored as JSON.
+# The files are append-only: for each file we store how many bytes were already merged (and their hash),
+# so only the rows appended since the last run are scanned and merged into the stored sketches.
+# Each run reads every file once: the hash of the merged bytes is checked and the same pass copies the appended rows.
+# A file whose merged bytes changed was rewritten, and the sketches are rebuilt from scratch.
+
+# Directory of the stored sketches
+diretorio_sketches = 'dados/sketches'
+
+# Use the stored sketches instead of profiling the full history (PROJECT14_SKETCHES=1)
+usar_sketches = os.environ.get('PROJECT14_SKETCHES', '0') == '1'
+
+# KLL quantile sketch (Karnin, Lang and Liberty): mergeable, with error proportional to 1 / k
+class SketchKLL:
+
+    def __init__(self, k = 200, c = 2.0 / 3.0):
+        self.k = k
+        self.c = c
+        self.compactadores = [[]]
+
+    # Capacity of the compactor at level h (the top levels keep more items)
+    def capacidade(self, h):
+        altura = len(self.compactadores) - h - 1
+        return int(math.ceil((self.c ** altura) * self.k)) + 1
+
+    def tamanho(self):
+        return builtins.sum(len(compactador) for compactador in self.compactadores)
+
+    def tamanho_maximo(self):
+        return builtins.sum(self.capacidade(h) for h in range(len(self.compactadores)))
+
+    # Compact the first full level: half of its items (the even or the odd ones) go to the next level with double weight
+    def comprimir(self):
+        while self.tamanho() >= self.tamanho_maximo():
+            for h in range(len(self.compactadores)):
+                if len(self.compactadores[h]) >= self.capacidade(h):
+                    if h + 1 == len(self.compactadores):
+                        self.compactadores.append([])
+                    itens = sorted(self.compactadores[h])
+                    sobra = itens[-1:] if len(itens) % 2 == 1 else []
+                    itens = itens[:len(itens) - len(sobra)]
+                    self.compactadores[h + 1].extend(itens[random.randint(0, 1)::2])
+                    self.compactadores[h] = sobra
+                    break
+
+    def atualizar(self, valor):
+        self.compactadores[0].append(valor)
+        if len(self.compactadores[0]) >= self.capacidade(0):
+            self.comprimir()
+
+    def merge(self, outro):
+        while len(self.compactadores) < len(outro.compactadores):
+            self.compactadores.append([])
+        for h, compactador in enumerate(outro.compactadores):
+            self.compactadores[h].extend(compactador)
+        self.comprimir()
+        return self
+
+    # Approximate quantiles from the weighted items (the items of level h weigh 2^h)
+    def quantis(self, probabilidades):
+        itens = sorted((valor, 2 ** h) for h, compactador in enumerate(self.compactadores) for valor in compactador)
+        if len(itens) == 0:
+            return [None for p in probabilidades]
+        peso_total = builtins.sum(peso for valor, peso in itens)
+        resultado = []
+        for p in probabilidades:
+            acumulado = 0
+            for valor, peso in itens:
+                acumulado += peso
+                if acumulado >= p * peso_total:
+                    break
+            resultado.append(valor)
+        return resultado
+
+    def to_dict(self):
+        return {'k': self.k, 'c': self.c, 'compactadores': self.compactadores}
+
+    @staticmethod
+    def from_dict(d):
+        sketch = SketchKLL(d['k'], d['c'])
+        sketch.compactadores = d['compactadores']
+        return sketch
+
+# Sketch of a column: count, nulls, min/max, central moments (mean, M2, M3) and quantiles
+class SketchColuna:
+
+    def __init__(self, k = 200):
+        self.n = 0
+        self.nulos = 0
+        self.minimo = None
+        self.maximo = None
+        self.media = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.kll = SketchKLL(k)
+
+    def atualizar(self, valor):
+        if valor is None:
+            self.nulos += 1
+            return
+        valor = float(valor)
+        self.minimo = valor if self.minimo is None else builtins.min(self.minimo, valor)
+        self.maximo = valor if self.maximo is None else builtins.max(self.maximo, valor)
+        self.kll.atualizar(valor)
+
+        # Incremental update of the central moments
+        n = self.n + 1
+        delta = valor - self.media
+        delta_n = delta / n
+        termo = delta * delta_n * self.n
+        self.media += delta_n
+        self.m3 += termo * delta_n * (n - 2) - 3 * delta_n * self.m2
+        self.m2 += termo
+        self.n = n
+
+    # Merge of the central moments of two sketches (Pebay's formulas)
+    def merge(self, outro):
+        if outro.n > 0:
+            n = self.n + outro.n
+            delta = outro.media - self.media
+            m2 = self.m2 + outro.m2 + delta ** 2 * self.n * outro.n / n
+            m3 = (self.m3 + outro.m3 + delta ** 3 * self.n * outro.n * (self.n - outro.n) / n ** 2
+                  + 3 * delta * (self.n * outro.m2 - outro.n * self.m2) / n)
+            self.media += delta * outro.n / n
+            self.m2, self.m3, self.n = m2, m3, n
+            self.minimo = outro.minimo if self.minimo is None else builtins.min(self.minimo, outro.minimo)
+            self.maximo = outro.maximo if self.maximo is None else builtins.max(self.maximo, outro.maximo)
+            self.kll.merge(outro.kll)
+        self.nulos += outro.nulos
+        return self
+
+    # Statistics in the same format of the profiler (skewness as computed by Spark)
+    def estatisticas(self, probabilidades):
+        return {'nulos': self.nulos,
+                'minimo': self.minimo,
+                'maximo': self.maximo,
+                'media': self.media if self.n > 0 else None,
+                'variancia': self.m2 / (self.n - 1) if self.n > 1 else None,
+                'assimetria': math.sqrt(self.n) * self.m3 / self.m2 ** 1.5 if self.m2 > 0 else None,
+                'quantis': self.kll.quantis(probabilidades)}
+
+    def to_dict(self):
+        return {'n': self.n, 'nulos': self.nulos, 'minimo': self.minimo, 'maximo': self.maximo,
+                'media': self.media, 'm2': self.m2, 'm3': self.m3, 'kll': self.kll.to_dict()}
+
+    @staticmethod
+    def from_dict(d):
+        sketch = SketchColuna(d['kll']['k'])
+        sketch.n, sketch.nulos, sketch.minimo, sketch.maximo = d['n'], d['nulos'], d['minimo'], d['maximo']
+        sketch.media, sketch.m2, sketch.m3 = d['media'], d['m2'], d['m3']
+        sketch.kll = SketchKLL.from_dict(d['kll'])
+        return sketch
+
+# Function to build the sketches of the numeric columns of a dataframe in a single pass
+# (one sketch per partition, merged in a tree)
+def func_sketches_dataframe(df, k = 200):
+
+    # Positions of the numeric columns (the other columns only count for the rows without nulls)
+    posicoes = [i for i, campo in enumerate(df.schema.fields) if isinstance(campo.dataType, NumericType)]
+
+    # Sketches of one partition: [number of rows, number of rows without nulls, sketch of each numeric column]
+    def sketches_particao(linhas):
+        num_linhas, num_linhas_completas = 0, 0
+        sketches = [SketchColuna(k) for i in posicoes]
+        for linha in linhas:
+            num_linhas += 1
+            num_linhas_completas += 1 if all(valor is not None for valor in linha) else 0
+            for sketch, i in zip(sketches, posicoes):
+                sketch.atualizar(linha[i])
+        yield [num_linhas, num_linhas_completas, sketches]
+
+    def merge_sketches(a, b):
+        return [a[0] + b[0], a[1] + b[1], [x.merge(y) for x, y in zip(a[2], b[2])]]
+
+    num_linhas, num_linhas_completas, sketches = df.rdd.mapPartitions(sketches_particao).treeReduce(merge_sketches)
+    return num_linhas, num_linhas_completas, dict(zip([df.columns[i] for i in posicoes], sketches))
+
+# Function to read a CSV file in one pass: the hash of its first `inicio` bytes (the rows already merged) is computed,
+# and the bytes after them are copied to a batch file (after the header of the file) and added to the same hash.
+# The end of the file ends the last row, even without a line break.
+# Returns the hash of the merged bytes, the hash and the size of the whole file, if it ends with a line break
+# and the number of bytes copied
+def func_ler_trecho_csv(caminho, inicio, destino, tamanho_bloco = 1 << 20):
+    sha256 = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo, open(destino, 'wb') as saida:
+        cabecalho = arquivo.readline()
+        sha256.update(cabecalho)
+        saida.write(cabecalho)
+        ultimo = cabecalho[-1:]
+
+        # Bytes already merged
+        restante = inicio - len(cabecalho)
+        while restante > 0:
+            bloco = arquivo.read(builtins.min(tamanho_bloco, restante))
+            if not bloco:
+                break
+            sha256.update(bloco)
+            ultimo = bloco[-1:]
+            restante -= len(bloco)
+        hash_mesclado = sha256.hexdigest()
+
+        # Bytes appended since the last merge
+        copiados = 0
+        for bloco in iter(lambda: arquivo.read(tamanho_bloco), b''):
+            sha256.update(bloco)
+            saida.write(bloco)
+            ultimo = bloco[-1:]
+            copiados += len(bloco)
+        tamanho = arquivo.tell()
+    return hash_mesclado, sha256.hexdigest(), tamanho, ultimo == b'\n', copiados
+
+# Function to merge the rows appended to the files since the last run into the stored sketches of a dataset
+def func_atualizar_sketches(nome, arquivos, versao = None):
+
+    # Empty sketches
+    def sketches_vazios():
+        return {'lotes': {}, 'num_linhas': 0, 'num_linhas_completas': 0, 'colunas': {}}
+
+    # Stored sketches (for each file, the number of bytes already merged, their hash and if they end with a line break)
+    caminho_sketches = os.path.join(diretorio_sketches, nome + '.json')
+    armazenado = sketches_vazios()
+    if os.path.exists(caminho_sketches):
+        with open(caminho_sketches) as arquivo:
+            armazenado = json.load(arquivo)
+        armazenado['colunas'] = {coluna: SketchColuna.from_dict(d) for coluna, d in armazenado['colunas'].items()}
+
+        # The old format doesn't tell which rows of a file were merged, so the sketches are rebuilt
+        if not isinstance(armazenado['lotes'], dict):
+            armazenado = sketches_vazios()
+
+    # Read each file once, copying the rows appended since the last merge to a batch file
+    # If a file was rewritten (its merged bytes changed, or its last merged row didn't end with a line break and
+    # was extended), the merged rows can't be told apart from the new ones: the sketches are rebuilt from scratch
+    os.makedirs(diretorio_sketches, exist_ok = True)
+    for _ in range(2):
+        lotes, reescrito = [], False
+        for j, caminho in enumerate(arquivos):
+            lote = armazenado['lotes'].get(caminho)
+            inicio = lote['bytes'] if lote is not None else 0
+            caminho_lote = os.path.join(diretorio_sketches, nome + '_lote_' + str(j) + '.csv')
+            hash_mesclado, hash_arquivo, tamanho, quebra_final, copiados = func_ler_trecho_csv(caminho, inicio, caminho_lote)
+            if lote is not None and (tamanho < inicio or hash_mesclado != lote['sha256'] or (tamanho > inicio and not lote.get('quebra_final', True))):
+                reescrito = True
+                break
+            lotes.append((caminho, caminho_lote, copiados, {'bytes': tamanho, 'sha256': hash_arquivo, 'quebra_final': quebra_final}))
+        if not reescrito:
+            break
+        print("\nThe files of " + nome + " were rewritten: rebuilding the sketches from scratch...")
+        armazenado = sketches_vazios()
+
+    # Scan only the batches with new rows
+    for caminho, caminho_lote, copiados, lote in lotes:
+        if copiados > 0:
+            print("\nMerging the rows appended to " + caminho + " into the sketches of " + nome + "...")
+            num_linhas, num_linhas_completas, sketches = func_sketches_dataframe(func_carregar_dados(caminho_lote, nome, versao))
+            armazenado['num_linhas'] += num_linhas
+            armazenado['num_linhas_completas'] += num_linhas_completas
+            for coluna, sketch in sketches.items():
+                armazenado['colunas'][coluna] = armazenado['colunas'][coluna].merge(sketch) if coluna in armazenado['colunas'] else sketch
+            armazenado['lotes'][caminho] = lote
+
+            # Save after each file, so an interrupted run doesn't merge the same rows twice
+            with open(caminho_sketches, 'w') as arquivo:
+                json.dump(dict(armazenado, colunas = {coluna: sketch.to_dict() for coluna, sketch in armazenado['colunas'].items()}), arquivo)
+        os.remove(caminho_lote)
+
+    return armazenado
+
+# Function to build the profile of the data from the stored sketches (no scan of the data)
+def func_perfil_de_sketches(sketches, probabilidades = probabilidades_outliers):
+    estatisticas = {coluna: sketch.estatisticas(probabilidades) for coluna, sketch in sketches['colunas'].items()}
+    return PerfilDados(sketches['num_linhas'], sketches['num_linhas_completas'], estatisticas, list(probabilidades))
+
+"""
+===========================================
+QUANTILE OPTIONS AND BENCHMARK
+===========================================
+"""
+
+# The clipping quantiles (1st and 99th percentiles) are only as good as the sketch that estimates them.
+# The relative error, the type of sketch and the sampling fraction are options, and the benchmark below
+# measures the runtime and the error against the exact quantiles at several data sizes,
+# so the settings can be chosen per dataset size with evidence.
+
+# Function to compute the quantiles of several columns with the chosen options
+# - gk: Greenwald-Khanna sketch of Spark (approxQuantile), a single job for all the columns
+# - kll: mergeable KLL sketch (the same one stored by the incremental statistics), a single job
+# - exato: exact percentiles (sorts the data, only feasible for small datasets)
+def func_quantis(df, colunas, probabilidades, erro_relativo = None, tipo_sketch = None, fracao_amostra = None, semente = 42):
+
+    # Options not given come from the configuration
+    erro_relativo = configuracao_quantis['erro_relativo'] if erro_relativo is None else erro_relativo
+    tipo_sketch = configuracao_quantis['tipo_sketch'] if tipo_sketch is None else tipo_sketch
+    fracao_amostra = configuracao_quantis['fracao_amostra'] if fracao_amostra is None else fracao_amostra
+
+    # Estimate the quantiles on a sample of the rows
+    if fracao_amostra < 1.0:
+        df = df.sample(fraction = fracao_amostra, seed = semente)
+
+    if tipo_sketch == 'gk':
+        return dict(zip(colunas, df.approxQuantile(colunas, probabilidades, erro_relativo)))
+
+    if tipo_sketch == 'kll':
+        k = builtins.max(8, int(math.ceil(2.0 / erro_relativo)))
+        num_linhas, num_linhas_completas, sketches = func_sketches_dataframe(df.select(colunas), k = k)
+        return {coluna: sketches[coluna].kll.quantis(probabilidades) for coluna in colunas}
+
+    if tipo_sketch == 'exato':
+        linha = df.agg(*[expr('percentile(`' + coluna + '`, array(' + ', '.join(str(p) for p in probabilidades) + '))') for coluna in colunas]).collect()[0]
+        return {coluna: list(valor) for coluna, valor in zip(colunas, linha)}
+
+    raise ValueError("Unknown sketch type: " + str(tipo_sketch) + ". Use 'gk', 'kll' or 'exato'.")
+
+# Quantile benchmark: runtime and error of each configuration against the exact quantiles, at several data sizes.
+# The data of each size is generated by replicating the column (and truncating it), so the distribution is kept.
+def func_benchmark_quantis(df, coluna, tamanhos = [10000, 100000, 1000000], configuracoes = None, probabilidades = probabilidades_outliers):
+
+    # Default configurations
+    if configuracoes is None:
+        configuracoes = [{'tipo_sketch': 'gk', 'erro_relativo': 0.25, 'fracao_amostra': 1.0},
+                         {'tipo_sketch': 'gk', 'erro_relativo': 0.05, 'fracao_amostra': 1.0},
+                         {'tipo_sketch': 'gk', 'erro_relativo': 0.01, 'fracao_amostra': 1.0},
+                         {'tipo_sketch': 'gk', 'erro_relativo': 0.001, 'fracao_amostra': 1.0},
+                         {'tipo_sketch': 'gk', 'erro_relativo': 0.01, 'fracao_amostra': 0.1},
+                         {'tipo_sketch': 'kll', 'erro_relativo': 0.01, 'fracao_amostra': 1.0}]
+
+    # Base column and its number of rows
+    df_base = df.select(coluna).na.drop()
+    num_linhas_base = df_base.count()
+
+    resultados = []
+    for tamanho in tamanhos:
+
+        # Data of the given size, cached so every configuration reads the same rows
+        replicas = int(math.ceil(float(tamanho) / num_linhas_base))
+        df_tamanho = df_base.crossJoin(spark.range(replicas).select(lit(1).alias('_replica'))).select(coluna).limit(tamanho).cache()
+        df_tamanho.count()
+
+        # Exact quantiles
+        exatos = func_quantis(df_tamanho, [coluna], probabilidades, tipo_sketch = 'exato', fracao_amostra = 1.0)[coluna]
+
+        for configuracao in configuracoes:
+
+            # Runtime of the configuration
+            inicio = time.perf_counter()
+            estimados = func_quantis(df_tamanho, [coluna], probabilidades, **configuracao)[coluna]
+            tempo = time.perf_counter() - inicio
+
+            # Value error and rank error (fraction of rows between the estimated and the exact quantile)
+            ranks = df_tamanho.agg(*[avg((col(coluna) <= estimado).cast('double')) for estimado in estimados]).collect()[0]
+            resultados.append(dict(configuracao,
+                                   tamanho = tamanho,
+                                   tempo_segundos = tempo,
+                                   erro_valor = builtins.max(builtins.abs(e - x) for e, x in zip(estimados, exatos)),
+                                   erro_rank = builtins.max(builtins.abs(r - p) for r, p in zip(ranks, probabilidades))))
+
+        df_tamanho.unpersist()
+
+    # Print the report
+    print('\033[1m' + "Quantile Benchmark (" + coluna + "):" + '\033[0m')
+    for resultado in resultados:
+        print(resultado)
+
+    return resultados
+
+# Profile the data
+# With the sketches, only the rows appended since the last run are scanned
+if usar_sketches:
+    perfil_dados = func_perfil_de_sketches(func_atualizar_sketches('concrete', [caminho_dados]))
+else:
+    perfil_dados = func_perfil_dados(gerenciador_cache.obter('dados'))
+gerenciador_cache.concluir('perfil')
+
 # Number of records
-dados.count()
+print('Number of records:', perfil_dados.num_linhas)
+
+# Quantile benchmark, to choose configuracao_quantis for the size of the data (PROJECT14_BENCHMARK_QUANTIS=1)
+if os.environ.get('PROJECT14_BENCHMARK_QUANTIS', '0') == '1':
+    func_benchmark_quantis(dados, 'age')
 
 # Visualize the data in the default Spark DataFrame
-dados.show(10)
+func_acao_exploratoria('dados.show', lambda: dados.show(10))
 
 # View data in Pandas format
-dados.limit(10).toPandas()
+func_acao_exploratoria('dados.toPandas', lambda: dados.limit(10).toPandas())
 
-# Schema
-dados.printSchema()
+# Schema (only reads the metadata, so it doesn't trigger a job)
+func_acao_exploratoria('dados.printSchema', lambda: dados.printSchema(), num_jobs = 0)
 
 """
 ===========================================
@@ -55,20 +1058,166 @@ DATA PREPARATION AUTOMATION MODULE
 # We will focus this project on Machine Learning, but always remember to check for missing values.
 
 # We separate the missing data (if any) and remove it (if any)
+# The counts come from the profile, so no extra job is needed
 dados_com_linhas_removidas = dados.na.drop()
-print('Number of rows before removing missing values:', dados.count())
-print('Number of rows after removing missing values:', dados_com_linhas_removidas.count())
+print('Number of rows before removing missing values:', perfil_dados.num_linhas)
+print('Number of rows after removing missing values:', perfil_dados.num_linhas_completas)
+
+# Fitted preprocessing model
+# It keeps every decision taken by the data preparation module (indexers, clipping quantiles,
+# skew-driven transformations and the MinMax scaler) so new data can be prepared with a single
+# transform, without fitting anything again or recomputing statistics.
+class ModeloPrep:
+
+    def __init__(self, variaveis_numericas, variaveis_categoricas, variavel_saida):
+
+        # Input variables and target variable
+        self.variaveis_numericas = variaveis_numericas
+        self.variaveis_categoricas = variaveis_categoricas
+        self.variavel_saida = variavel_saida
+
+        # Fitted string indexers (a single multi-column indexer for all the categorical variables)
+        self.indexadores = []
+
+        # Clipping quantiles of each numeric variable and transformation applied to it ('log' or 'exp')
+        self.limites = {}
+        self.transformacoes = {}
+
+        # Fitted MinMax scaler (None if the data is not standardized)
+        self.scaler = None
+
+        # Range [min, max] of each attribute when the standardization is derived from the statistics
+        # of the data (profile or sketches) instead of fitting the MinMax scaler
+        self.escala = {}
+
+    # Final list of attributes (numeric variables plus the indexed categorical variables)
+    def lista_atributos(self):
+        return self.variaveis_numericas + [coluna + "_num" for coluna in self.variaveis_categoricas]
+
+    # Select the input columns and, if the target is present, rename it to label (required by Spark)
+    def selecionar(self, df):
+        colunas = self.variaveis_numericas + self.variaveis_categoricas
+        if self.variavel_saida not in df.columns:
+            return df.select(colunas)
+        novo_df = df.select(colunas + [self.variavel_saida]).withColumnRenamed(self.variavel_saida, 'label')
+        
+        # We convert the target variable to numeric type as float (encoding)
+        if not isinstance(novo_df.schema['label'].dataType, IntegerType):
+            novo_df = novo_df.withColumn("label", novo_df["label"].cast(FloatType()))
+        return novo_df
+
+    # Expression of a column after the outlier treatment (clipping plus log/exp transformation)
+    def expressao_outliers(self, df, coluna):
+        if coluna not in self.transformacoes:
+            return df[coluna]
+        limite_inferior, limite_superior = self.limites[coluna]
+        valor = when(df[coluna] < limite_inferior, limite_inferior).when(df[coluna] > limite_superior, limite_superior).otherwise(df[coluna])
+        if self.transformacoes[coluna] == 'log':
+            return log(valor + 1).alias(coluna)
+        return exp(valor).alias(coluna)
+
+    # Expression of a column after the outlier treatment and the standardization derived from the statistics
+    # (same result as the MinMax scaler: range [0, 1], and 0.5 for constant attributes)
+    def expressao_coluna(self, df, coluna):
+        valor = self.expressao_outliers(df, coluna)
+        if coluna not in self.escala:
+            return valor
+        minimo, maximo = self.escala[coluna]
+        if maximo == minimo:
+            return lit(0.5).alias(coluna)
+        return ((valor - minimo) / (maximo - minimo)).alias(coluna)
+
+    # Derive the standardization from the min/max of the statistics, without scanning the data.
+    # The outlier treatment is monotonic, so the range of each transformed attribute is the transformation
+    # of the range of the original variable. The indexed categories go from 0 to the number of labels - 1.
+    # Returns False (and keeps no scale) when a bound can't be transformed to a finite value: exp overflows above ~709
+    # and log(v + 1) is undefined for v <= -1, where Spark gives inf or null. The scaler is fitted on the data instead.
+    def definir_escala(self, perfil):
+
+        # Transformation of a bound (None if the result is not finite)
+        def transformar(valor, transformacao):
+            if transformacao == 'log':
+                return math.log(valor + 1) if valor > -1 else None
+            return math.exp(valor) if valor <= math.log(sys.float_info.max) else None
+
+        escala = {}
+        for coluna in self.variaveis_numericas:
+            minimo, maximo = perfil.estatisticas[coluna]['minimo'], perfil.estatisticas[coluna]['maximo']
+            if coluna in self.transformacoes:
+                limite_inferior, limite_superior = self.limites[coluna]
+                minimo = transformar(builtins.min(builtins.max(minimo, limite_inferior), limite_superior), self.transformacoes[coluna])
+                maximo = transformar(builtins.min(builtins.max(maximo, limite_inferior), limite_superior), self.transformacoes[coluna])
+                if minimo is None or maximo is None or math.isinf(maximo - minimo):
+                    return False
+            escala[coluna] = [float(minimo), float(maximo)]
+        for indexador in self.indexadores:
+            for coluna, rotulos in zip(indexador.getOutputCols(), indexador.labelsArray):
+                escala[coluna] = [0.0, float(len(rotulos) - 1)]
+        self.escala = escala
+        return True
+
+    # Apply the indexers and the outlier treatment and vectorize the attributes
+    def vetorizar(self, df):
+
+        # Apply the string indexers
+        for indexador in self.indexadores:
+            df = indexador.transform(df)
+
+        # Clip the outliers and apply the transformation chosen for each variable
+        # All the columns are emitted in a single select, so the plan stays flat however wide the data is
+        if len(self.transformacoes) != 0 or len(self.escala) != 0:
+            df = df.select([self.expressao_coluna(df, coluna) for coluna in df.columns])
+
+        # Apply the vectorizer
+        vetorizador = VectorAssembler(inputCols = self.lista_atributos(), outputCol = 'features')
+        return vetorizador.transform(df).select(['features'] + (['label'] if 'label' in df.columns else []))
+
+    # Standardize the vectorized data with the fitted scaler
+    def padronizar(self, df):
+        if self.scaler is None:
+            return df
+        return self.scaler.transform(df).drop('features').withColumnRenamed('scaledFeatures', 'features')
+
+    # Prepare new data in a single transform
+    def transform(self, df):
+        return self.padronizar(self.vetorizar(self.selecionar(df)))
+
+    # Save the model: the decisions go to a JSON file and the fitted MLlib models to subdirectories
+    def save(self, caminho):
+        os.makedirs(caminho, exist_ok = True)
+        metadados = {'variaveis_numericas': self.variaveis_numericas,
+                     'variaveis_categoricas': self.variaveis_categoricas,
+                     'variavel_saida': self.variavel_saida,
+                     'limites': self.limites,
+                     'transformacoes': self.transformacoes,
+                     'escala': self.escala,
+                     'num_indexadores': len(self.indexadores),
+                     'padronizado': self.scaler is not None}
+        with open(os.path.join(caminho, 'modelo_prep.json'), 'w') as arquivo:
+            json.dump(metadados, arquivo)
+        for i, indexador in enumerate(self.indexadores):
+            indexador.write().overwrite().save(os.path.join(caminho, 'indexador_' + str(i)))
+        if self.scaler is not None:
+            self.scaler.write().overwrite().save(os.path.join(caminho, 'scaler'))
+
+    # Load a saved model
+    @staticmethod
+    def load(caminho):
+        with open(os.path.join(caminho, 'modelo_prep.json')) as arquivo:
+            metadados = json.load(arquivo)
+        modelo = ModeloPrep(metadados['variaveis_numericas'], metadados['variaveis_categoricas'], metadados['variavel_saida'])
+        modelo.limites = metadados['limites']
+        modelo.transformacoes = metadados['transformacoes']
+        modelo.escala = metadados['escala']
+        modelo.indexadores = [StringIndexerModel.load(os.path.join(caminho, 'indexador_' + str(i))) for i in range(metadados['num_indexadores'])]
+        if metadados['padronizado']:
+            modelo.scaler = MinMaxScalerModel.load(os.path.join(caminho, 'scaler'))
+        return modelo
 
 # Data preparation function
-def func_modulo_prep_dados(df, variaveis_entrada, variavel_saida, tratar_outliers = True, padronizar_dados = True):
+# Returns the prepared data and the fitted preprocessing model (ModeloPrep)
+def func_modulo_prep_dados(df, variaveis_entrada, variavel_saida, tratar_outliers = True, padronizar_dados = True, perfil = None):
 
-    # Let's generate a new dataframe, renaming the argument that represents the output variable.
-    novo_df = df.withColumnRenamed(variavel_saida, 'label')
-    
-    # We convert the target variable to numeric type as float (encoding)
-    if str(novo_df.schema['label'].dataType) != 'IntegerType':
-        novo_df = novo_df.withColumn("label", novo_df["label"].cast(FloatType()))
-    
     # Checklists for variables
     variaveis_numericas = []
     variaveis_categoricas = []
@@ -77,104 +1226,107 @@ def func_modulo_prep_dados(df, variaveis_entrada, variavel_saida, tratar_outlier
     for coluna in variaveis_entrada:
         
         # Check if the variable is of type string
-        if str(novo_df.schema[coluna].dataType) == 'StringType':
-            
-            # Define the variable with a suffix
-            novo_nome_coluna = coluna + "_num"
+        if isinstance(df.schema[coluna].dataType, StringType):
             
             # Add to the list of categorical variables
-            variaveis_categoricas.append(novo_nome_coluna)
+            variaveis_categoricas.append(coluna)
             
         else:
             
             # If it is not a variable of type string, then it is numeric and we add it to the corresponding list
             variaveis_numericas.append(coluna)
-            
-            # We put the data in the dataframe of indexed variables
-            df_indexed = novo_df
 
-    # If the dataframe has data of type string, we apply indexing
-    # Check that the list of categorical variables is not empty
-    if len(variaveis_categoricas) != 0: 
-        
-        # Loop through the columns
-        for coluna in novo_df:
-            
-            # If the variable is of type string, we create, train and apply the indexer
-            if str(novo_df.schema[coluna].dataType) == 'StringType':
-                
-                # Create the indexer
-                indexer = StringIndexer(inputCol = coluna, outputCol = coluna + "_num") 
-                
-                # Train and apply the indexer
-                df_indexed = indexer.fit(novo_df).transform(novo_df)
-    else:
+    # Create the preprocessing model
+    modelo_prep = ModeloPrep(variaveis_numericas, variaveis_categoricas, variavel_saida)
+
+    # Keep only the columns used by the model, so the columnar source reads just these columns.
+    # Then let's generate a new dataframe, renaming the argument that represents the output variable.
+    novo_df = modelo_prep.selecionar(df)
 
-        # If we don't have categorical variables anymore, then we put the data in the indexed variables dataframe
-        df_indexed = novo_df
+    # If the dataframe has data of type string, we apply indexing
+    # A single multi-column indexer collects the label tables of every variable in one job
+    # and is applied in one projection (the output columns have the suffix _num)
+    if len(variaveis_categoricas) != 0:
+        indexer = StringIndexer(inputCols = variaveis_categoricas, outputCols = [coluna + "_num" for coluna in variaveis_categoricas])
+        modelo_prep.indexadores.append(indexer.fit(novo_df))
+
+    # The statistics are computed on the numeric variables, which are not changed by the indexers
+    df_indexed = novo_df
         
     # If it is necessary to handle outliers, we will do it now
     if tratar_outliers == True:
         print("\nApplying the treatment of outliers...")
         
-        # Dictionary
+        # Dictionaries of quantiles and skewness
         d = {}
+        assimetrias = {}
         
-        # Quartile dictionary of indexed dataframe variables (numeric variables only)
-        for col in variaveis_numericas: 
-            d[col] = df_indexed.approxQuantile(col,[0.01, 0.99], 0.25) 
+        # If we have the profile of the data, we reuse its statistics instead of scanning the data again
+        if perfil is not None and perfil.probabilidades == probabilidades_outliers:
+            for col in variaveis_numericas:
+                d[col] = perfil.quantis(col)
+                assimetrias[col] = perfil.assimetria(col)
+
+        elif len(variaveis_numericas) != 0:
+
+            # Quartile dictionary of indexed dataframe variables (numeric variables only)
+            # A single multi-column call computes the quantiles of every variable in one job
+            # (relative error, sketch type and sampling fraction come from configuracao_quantis)
+            d = func_quantis(df_indexed, variaveis_numericas, probabilidades_outliers)
+            
+            # We extract asymmetry from the data and use it to handle outliers
+            # A single aggregation computes the skewness of every variable in one job
+            skew = df_indexed.agg(*[skewness(df_indexed[col]) for col in variaveis_numericas]).collect()
+            assimetrias = dict(zip(variaveis_numericas, skew[0]))
+
+        # The clipping quantiles are kept in the model
+        modelo_prep.limites = {col: list(d[col]) for col in d}
         
-        # Now we apply transformation depending on the distribution of each variable
+        # Now we choose the transformation depending on the distribution of each variable
         for col in variaveis_numericas:
             
-            # We extract asymmetry from the data and use it to handle outliers
-            skew = df_indexed.agg(skewness(df_indexed[col])).collect() 
-            skew = skew[0][0]
+            # Skewness of the variable (constant variables have no skewness)
+            skew = assimetrias[col]
+            if skew is None:
+                continue
             
             # We check for asymmetry and then apply:
             
             # Log transform + 1 if skewness is positive
             if skew > 1:
-                indexed = df_indexed.withColumn(col, log(when(df[col] < d[col][0], d[col][0]).when(df_indexed[col] > d[col][1], d[col][1]).otherwise(df_indexed[col]) + 1).alias(col))
+                modelo_prep.transformacoes[col] = 'log'
                 print("\nA variável " + col + " was treated for positive asymmetry (right) with skew =", skew)
             
             # Exponential transformation if the skewness is negative
             elif skew < -1:
-                indexed = df_indexed.withColumn(col,exp(when(df[col] < d[col][0], d[col][0]).when(df_indexed[col] > d[col][1], d[col][1]).otherwise(df_indexed[col])).alias(col))
+                modelo_prep.transformacoes[col] = 'exp'
                 print("\nA variável " + col + " was treated for negative skewness (left) with skew =", skew)
                 
             # Asymmetry between -1 and 1 we don't need to apply transformation to the data
 
-    # Vectorization
-    
-    # Final list of attributes
-    lista_atributos = variaveis_numericas + variaveis_categoricas
-
-    # Create vectorizer for attributes
-    vetorizador = VectorAssembler(inputCols = lista_atributos, outputCol = 'features')
-    
-    # Apply the vectorizer to the dataset
-    dados_vetorizados = vetorizador.transform(df_indexed).select('features', 'label')
+    # Vectorization (indexers, outlier treatment and vectorizer)
+    dados_vetorizados = modelo_prep.vetorizar(novo_df)
     
     # If the standardize_data flag is set to True, then we standardize the data by placing them on the same scale
     if padronizar_dados == True:
         print("\nStandardizing the dataset to the range 0 to 1...")
         
-        # Create the scaler
-        scaler = MinMaxScaler(inputCol = "features", outputCol = "scaledFeatures")
+        # If we have the statistics of the data (profile or sketches), the min/max of each attribute
+        # is derived from them and applied in the same projection of the outlier treatment (no extra scan)
+        # (unless a transformed bound is not finite, then the scaler is fitted on the data)
+        if perfil is not None and all(perfil.estatisticas[col]['minimo'] is not None for col in variaveis_numericas) and modelo_prep.definir_escala(perfil):
+            dados_finais = modelo_prep.vetorizar(novo_df).select('label', 'features')
 
-        # Compute the statistics summary and generate the standardizer
-        global scalerModel
-        scalerModel = scaler.fit(dados_vetorizados)
+        else:
 
-        # Defaults variables to range [min, max]
-        dados_padronizados = scalerModel.transform(dados_vetorizados)
-        
-        # Generate the final data
-        dados_finais = dados_padronizados.select('label', 'scaledFeatures')
-        
-        # Rename the columns (required by Spark)
-        dados_finais = dados_finais.withColumnRenamed('scaledFeatures', 'features')
+            # Create the scaler
+            scaler = MinMaxScaler(inputCol = "features", outputCol = "scaledFeatures")
+
+            # Compute the statistics summary and generate the standardizer
+            modelo_prep.scaler = scaler.fit(dados_vetorizados)
+
+            # Defaults variables to range [min, max]
+            dados_finais = modelo_prep.padronizar(dados_vetorizados).select('label', 'features')
         
         print("\nProcess concluded!")
 
@@ -183,7 +1335,7 @@ def func_modulo_prep_dados(df, variaveis_entrada, variavel_saida, tratar_outlier
         print("\nThe data will not be standardized because the standardizar_data flag has the value False.")
         dados_finais = dados_vetorizados
     
-    return dados_finais
+    return dados_finais, modelo_prep
 
 # Now we apply the data preparation module.
 
@@ -193,11 +1345,23 @@ variaveis_entrada = dados.columns[:-1]
 # Target Variable
 variavel_saida = dados.columns[-1] 
 
+# Directory where the fitted preprocessing model is saved
+caminho_modelo_prep = 'modelos/modelo_prep'
+
 # Apply the function
-dados_finais = func_modulo_prep_dados(dados, variaveis_entrada, variavel_saida)
+dados_finais, modelo_prep = func_modulo_prep_dados(gerenciador_cache.obter('dados'), variaveis_entrada, variavel_saida, perfil = perfil_dados)
+
+# Persist the prepared data until the correlation and the split are done
+# (it is materialized now, so the raw data can be released)
+# With a checkpoint mode, the lineage of the prepared data is truncated here
+dados_finais = gerenciador_cache.persistir('dados_finais', dados_finais, ['correlacao', 'divisao'], materializar = True, checkpoint = modo_checkpoint)
+gerenciador_cache.concluir('prep')
+
+# Save the preprocessing model to prepare new data in production
+modelo_prep.save(caminho_modelo_prep)
 
 # View
-dados_finais.show(10, truncate = False)
+func_acao_exploratoria('dados_finais.show', lambda: dados_finais.show(10, truncate = False))
 
 """
 =======================
@@ -214,7 +1378,8 @@ VERIFYING CORRELATION
 # - .80-1.0 (very strong correlation)
 
 # Extract the correlation
-coeficientes_corr = Correlation.corr(dados_finais, 'features', 'pearson').collect()[0][0]
+coeficientes_corr = Correlation.corr(gerenciador_cache.obter('dados_finais'), 'features', 'pearson').collect()[0][0]
+gerenciador_cache.concluir('correlacao')
 
 # Convert the result to an array
 array_corr = coeficientes_corr.toArray()
@@ -223,9 +1388,753 @@ array_corr = coeficientes_corr.toArray()
 for item in array_corr:
     print(item[7])
 
+"""
+===========================================
+GBT EARLY STOPPING
+===========================================
+"""
+
+# GBT trains the full maxIter ensemble even after the validation error stops improving.
+# With early stopping, a fraction of the training rows is flagged by a validation indicator column: GBT trains on the
+# other rows and stops when an iteration doesn't improve the validation error by at least the tolerance
+# (Spark stops at the first iteration without improvement). The number of iterations used goes to the results.
+# Set the environment variable PROJECT14_PARADA_ANTECIPADA=0 to disable it.
+parada_antecipada_gbt = os.environ.get('PROJECT14_PARADA_ANTECIPADA', '1') == '1'
+
+# Fraction of the training rows used for validation, relative tolerance and name of the indicator column
+fracao_validacao_gbt = 0.2
+tolerancia_gbt = 0.01
+coluna_validacao_gbt = 'validacao_gbt'
+
+# Number of iterations used by the best GBT model
+iteracoes_modelos = {}
+
+"""
+===========================================
+TRAIN / TEST SPLIT
+===========================================
+"""
+
+# randomSplit without a seed can give a different split at each action on the training or test data,
+# and even with a seed the split depends on how the data is partitioned, which risks row leakage.
+# The split below assigns each row by the hash of its content and a seed, so it is the same however the
+# data is partitioned. The two sets are materialized once (in the cache or as Parquet files) and we record
+# their row counts and fingerprints, so every model reads exactly the same data.
+
+# Seed of the split
+semente_divisao = 42
+
+# Directory where the split is written as Parquet (None keeps it only in the cache)
+caminho_divisao = os.environ.get('PROJECT14_CAMINHO_DIVISAO')
+
+# Function to compute the number of rows and the fingerprint (sum of the row hashes) of a dataframe in one job
+# (the 64-bit hashes are summed as decimal(38,0), so the sum doesn't overflow, which fails in ANSI mode)
+def func_fingerprint_dataframe(df):
+    hash_linha = xxhash64(*[vector_to_array(coluna) if coluna == 'features' else col(coluna) for coluna in df.columns])
+    linha = df.agg(count(lit(1)), sum(hash_linha.cast('decimal(38,0)'))).collect()[0]
+    return {'num_linhas': linha[0], 'fingerprint': int(linha[1]) if linha[1] is not None else None}
+
+# Deterministic split of the prepared data
+def func_divisao_treino_teste(df, proporcao_treino = 0.7, semente = semente_divisao, caminho = caminho_divisao):
+
+    # Position of each row in [0, 1), given by the hash of its content and the seed
+    hash_linha = xxhash64(vector_to_array('features'), col('label'), lit(semente))
+    posicao = ((hash_linha % 1000000 + 1000000) % 1000000) / 1000000.0
+    treino = df.where(posicao < proporcao_treino)
+    teste = df.where(posicao >= proporcao_treino)
+
+    # Validation indicator of the GBT early stopping (the rows keep it in every fold)
+    if parada_antecipada_gbt:
+        hash_validacao = xxhash64(vector_to_array('features'), col('label'), lit(semente + 1))
+        treino = treino.withColumn(coluna_validacao_gbt, ((hash_validacao % 1000000 + 1000000) % 1000000) / 1000000.0 < fracao_validacao_gbt)
+
+    # Write the split as Parquet and read it back, so it doesn't depend on the plan of the prepared data anymore
+    if caminho is not None:
+        treino.write.mode('overwrite').parquet(os.path.join(caminho, 'treino'))
+        teste.write.mode('overwrite').parquet(os.path.join(caminho, 'teste'))
+        treino = spark.read.parquet(os.path.join(caminho, 'treino'))
+        teste = spark.read.parquet(os.path.join(caminho, 'teste'))
+
+    # Persist the training data until the training is done and the test data until the evaluation is done
+    # With a checkpoint mode, the lineage is truncated again after the split
+    gerenciador_cache.persistir('dados_treino', treino, ['treino'], checkpoint = modo_checkpoint)
+    gerenciador_cache.persistir('dados_teste', teste, ['avaliacao'], checkpoint = modo_checkpoint)
+
+    # Row counts and fingerprints (these jobs also materialize the two sets in the cache)
+    metadados = {'semente': semente,
+                 'proporcao_treino': proporcao_treino,
+                 'treino': func_fingerprint_dataframe(gerenciador_cache.obter('dados_treino')),
+                 'teste': func_fingerprint_dataframe(gerenciador_cache.obter('dados_teste'))}
+    print("\nTrain/test split:", metadados)
+
+    # Save the metadata with the split
+    if caminho is not None:
+        with open(os.path.join(caminho, 'divisao.json'), 'w') as arquivo:
+            json.dump(metadados, arquivo)
+
+    return gerenciador_cache.obter('dados_treino'), gerenciador_cache.obter('dados_teste'), metadados
+
 # Split into Training and Test Data
-# Division with 70/30 ratio
-dados_treino, dados_teste = dados_finais.randomSplit([0.7,0.3])
+# Division with 70/30 ratio (both sets are materialized, so the prepared data can be released)
+dados_treino, dados_teste, metadados_divisao = func_divisao_treino_teste(gerenciador_cache.obter('dados_finais'))
+gerenciador_cache.concluir('divisao')
+
+"""
+===========================================
+TIME BUDGET
+===========================================
+"""
+
+# The retraining window is fixed, so the AutoML run has a global time budget.
+# The cross validation estimates the cost of each algorithm from a first (pilot) fit and shrinks its grid,
+# or skips the algorithm, when the full grid would not finish before the deadline.
+# When the deadline is reached, the algorithms still training are cancelled and the run returns
+# the best model found so far together with the partial results table.
+# Set the environment variable PROJECT14_TEMPO_LIMITE (in seconds) to enable it.
+tempo_limite_automl = float(os.environ['PROJECT14_TEMPO_LIMITE']) if 'PROJECT14_TEMPO_LIMITE' in os.environ else None
+
+# Deadline of the run (set when the AutoML starts)
+prazo_automl = None
+
+# Fraction of the remaining time reserved to retrain the best configuration on the full training data
+reserva_retreino = 0.2
+
+# Remaining time until the deadline (None if there is no time budget)
+def func_tempo_restante():
+    return None if prazo_automl is None else prazo_automl - time.perf_counter()
+
+# Regressors training at the moment (name of the pool -> weight): they run at the same time and share the cores
+regressores_em_treino = {}
+lock_regressores = threading.Lock()
+
+# Share of the cores of the regressor trained in the current thread: the weight of its pool over the weights
+# of the pools still training (1 outside the AutoML run)
+def func_fracao_nucleos():
+    pool = sc.getLocalProperty("spark.scheduler.pool")
+    with lock_regressores:
+        if pool not in regressores_em_treino:
+            return 1.0
+        return float(regressores_em_treino[pool]) / builtins.sum(regressores_em_treino.values())
+
+# Exception raised when an algorithm doesn't fit in the time budget
+class TempoEsgotado(Exception):
+    pass
+
+# Function to stop an algorithm before it starts a new step (a refit or an evaluation) after the deadline
+# (cancelling the job group only stops the jobs already running)
+def func_verificar_prazo(etapa):
+    restante = func_tempo_restante()
+    if restante is not None and restante <= 0:
+        raise TempoEsgotado("The time budget ended before " + etapa)
+
+"""
+===========================================
+SHARED CROSS-VALIDATION FOLDS
+===========================================
+"""
+
+# CrossValidator assigns the folds again for each regressor (and filters the training data again for each fold).
+# We assign the folds once, by the hash of each row and a seed, and persist the training and validation data
+# of each fold. Every regressor is cross-validated on exactly the same folds, which saves the repeated
+# filtering scans and makes the comparison between the algorithms fair.
+
+# Number of folds and seed of the fold assignment
+num_folds = 3
+semente_folds = 7
+
+# Function to assign the folds and persist the training and validation data of each fold
+def func_criar_folds(df, num_folds = num_folds, semente = semente_folds):
+
+    # Fold of each row, given by the hash of its content and the seed
+    hash_linha = xxhash64(vector_to_array('features'), col('label'), lit(semente))
+    df_folds = df.withColumn('fold', (hash_linha % num_folds + num_folds) % num_folds)
+
+    # Training and validation data of each fold, persisted until the training is done
+    folds = []
+    for i in range(num_folds):
+        treino_fold = gerenciador_cache.persistir('fold_' + str(i) + '_treino', df_folds.where(col('fold') != i).drop('fold'), ['treino'], materializar = True)
+        validacao_fold = gerenciador_cache.persistir('fold_' + str(i) + '_validacao', df_folds.where(col('fold') == i).drop('fold'), ['treino'], materializar = True)
+        folds.append((treino_fold, validacao_fold))
+
+    return folds
+
+# Each (fold, hyperparameters) fit is a small Spark job, so training them one after the other leaves the cluster idle.
+# The cross validation submits the fits from a thread pool. By default there is one thread per executor core,
+# bounded by the number of fits. The partitions of each fit are not taken into account: the small fits leave most
+# cores idle between their stages, and the driver work of one fit overlaps with the jobs of the others
+# (at least 2 threads whenever there are 2 fits, also on a single core).
+def func_paralelismo_automatico(num_tarefas):
+    nucleos = spark.sparkContext.defaultParallelism
+    return builtins.max(1, builtins.min(num_tarefas, builtins.max(2, nucleos)))
+
+# Result of the cross validation (same interface as the CrossValidatorModel of Spark)
+class ModeloValidacaoCruzada:
+
+    def __init__(self, bestModel, avgMetrics, melhores_parametros, aceleracao = None):
+        self.bestModel = bestModel
+        self.avgMetrics = avgMetrics
+        self.melhores_parametros = melhores_parametros
+
+        # Speed-up of the parallel cross validation (sum of the fit times / wall time)
+        self.aceleracao = aceleracao
+
+    def transform(self, df):
+        return self.bestModel.transform(df)
+
+# Cross validation on the shared folds (same interface as the CrossValidator of Spark)
+class ValidacaoCruzada:
+
+    # parallelism = None derives the number of threads automatically
+    def __init__(self, estimator, estimatorParamMaps, evaluator, folds, parallelism = None):
+        self.estimator = estimator
+        self.estimatorParamMaps = estimatorParamMaps
+        self.evaluator = evaluator
+        self.folds = folds
+        self.parallelism = parallelism
+
+    # Tree ensembles whose smaller settings are prefixes of the largest one: the first k trees of a forest,
+    # or the first k iterations of a GBT. Returns the parameter of the number of trees/iterations (or None).
+    def parametro_prefixo(self):
+        if isinstance(self.estimator, RandomForestRegressor):
+            return self.estimator.numTrees
+        if isinstance(self.estimator, GBTRegressor):
+            return self.estimator.maxIter
+        return None
+
+    # Groups of combinations that differ only in the number of trees/iterations (each group is trained once,
+    # with its largest setting). Without a prefix parameter, each combination is its own group.
+    def agrupar(self, combinacoes):
+        parametro = self.parametro_prefixo()
+        if parametro is None:
+            return [[i] for i in combinacoes]
+        grupos = {}
+        for i in combinacoes:
+            chave = tuple(sorted((p.name, str(v)) for p, v in self.estimatorParamMaps[i].items() if p.name != parametro.name))
+            grupos.setdefault(chave, []).append(i)
+        return list(grupos.values())
+
+    # Number of trees/iterations of a combination
+    def tamanho(self, i):
+        parametro = self.parametro_prefixo()
+        return self.estimatorParamMaps[i].get(parametro, self.estimator.getOrDefault(parametro))
+
+    # Metric of each prefix of a fitted ensemble on the validation data.
+    # The prediction of the first k trees is their weighted sum (GBT) or their average (RandomForest),
+    # computed from the predictions of each tree in a single projection.
+    def avaliar_prefixos(self, modelo, validacao_fold, grupo):
+        arvores, pesos = modelo.trees, modelo.treeWeights
+        media = isinstance(modelo, RandomForestRegressionModel)
+        df = validacao_fold
+        for j, arvore in enumerate(arvores):
+            df = arvore.setFeaturesCol(modelo.getFeaturesCol()).setPredictionCol('_arvore_' + str(j)).transform(df)
+
+        # Prediction of each prefix (an early-stopped GBT may have fewer trees than the prefix asks for)
+        colunas_previsao = {}
+        for i in grupo:
+            n = builtins.min(int(self.tamanho(i)), len(arvores))
+            soma = reduce(lambda a, b: a + b, [col('_arvore_' + str(j)) * pesos[j] for j in range(n)])
+            colunas_previsao[i] = (soma / n if media else soma).alias('_previsao_' + str(i))
+        df = df.select([col(self.evaluator.getLabelCol())] + list(colunas_previsao.values())).cache()
+
+        metricas = {i: self.evaluator.copy({self.evaluator.predictionCol: '_previsao_' + str(i)}).evaluate(df) for i in grupo}
+        df.unpersist()
+        return metricas
+
+    # Fit and evaluate one group of combinations on one fold, returning the metric of each combination and the time spent
+    # (after the deadline, the fit is not started and the metrics are None)
+    def avaliar(self, tarefa):
+        (treino_fold, validacao_fold), grupo = tarefa
+        if func_tempo_restante() is not None and func_tempo_restante() <= 0:
+            return {i: None for i in grupo}, 0.0
+        inicio = time.perf_counter()
+
+        # A single combination is fitted and evaluated as usual
+        if len(grupo) == 1:
+            modelo = self.estimator.fit(treino_fold, self.estimatorParamMaps[grupo[0]])
+            metricas = {grupo[0]: self.evaluator.evaluate(modelo.transform(validacao_fold))}
+
+        # Otherwise the largest ensemble is fitted once and its prefixes give the smaller settings
+        else:
+            maior = builtins.max(grupo, key = self.tamanho)
+            modelo = self.estimator.fit(treino_fold, self.estimatorParamMaps[maior])
+            metricas = self.avaliar_prefixos(modelo, validacao_fold, grupo)
+
+        return metricas, time.perf_counter() - inicio
+
+    # Average metric of each combination of hyperparameters over the folds, and the speed-up of the thread pool
+    def avaliar_grade(self):
+
+        # Groups of combinations of hyperparameters to evaluate and results already known
+        grupos = self.agrupar(range(len(self.estimatorParamMaps)))
+        resultados_conhecidos = {}
+        paralelismo = self.parallelism if self.parallelism is not None else func_paralelismo_automatico(len(grupos) * len(self.folds))
+
+        # With a time budget, the pilot fit (first group on the first fold) estimates the cost of the grid
+        # and the grid is shrunk (evenly spaced groups) to what fits before the deadline
+        restante = func_tempo_restante()
+        if restante is not None:
+            resultados_conhecidos[(0, 0)] = self.avaliar((self.folds[0], grupos[0]))
+            metricas_piloto, tempo_piloto = resultados_conhecidos[(0, 0)]
+            # (the regressor only gets the share of the cores of its pool while the others are training)
+            disponivel = (func_tempo_restante() * (1 - reserva_retreino)) * paralelismo * func_fracao_nucleos()
+            cabem = int(disponivel / builtins.max(tempo_piloto * len(self.folds), 1e-9))
+            if None in metricas_piloto.values() or cabem < 1:
+                raise TempoEsgotado("The time budget doesn't allow the cross validation of " + type(self.estimator).__name__)
+            if cabem < len(grupos):
+                mantidos = sorted(set(int(builtins.round(j * (len(grupos) - 1) / builtins.max(cabem - 1, 1))) for j in range(cabem)))
+                grupos = [grupos[g] for g in mantidos]
+                print("Time budget: the grid of " + type(self.estimator).__name__ + " was shrunk to " + str(len(grupos)) + " fit(s) per fold")
+
+        # One task per (fold, group of hyperparameters)
+        tarefas = [(f, g) for f in range(len(self.folds)) for g in range(len(grupos)) if (f, g) not in resultados_conhecidos]
+
+        # Run the tasks in the thread pool (the threads inherit the local properties, such as the scheduler pool and the job group)
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = paralelismo) as pool:
+            resultados = list(pool.map(inheritable_thread_target(self.avaliar), [(self.folds[f], grupos[g]) for f, g in tarefas]))
+        tempo_total = time.perf_counter() - inicio
+        resultados_conhecidos.update(zip(tarefas, resultados))
+
+        # Average metric of each combination over the folds
+        # (None for the combinations not evaluated on every fold because of the time budget)
+        metricas = [None for parametros in self.estimatorParamMaps]
+        for g, grupo in enumerate(grupos):
+            for i in grupo:
+                metricas_folds = [resultados_conhecidos[(f, g)][0][i] for f in range(len(self.folds))]
+                if None not in metricas_folds:
+                    metricas[i] = builtins.sum(metricas_folds) / len(self.folds)
+
+        # Speed-up achieved by the thread pool
+        aceleracao = builtins.sum(tempo for metricas_grupo, tempo in resultados) / tempo_total if tempo_total > 0 else None
+        print("Cross validation: " + str(len(resultados_conhecidos)) + " fits for " + str(len(self.estimatorParamMaps) * len(self.folds)) + " evaluations with " + str(paralelismo) + " thread(s), speed-up of", aceleracao)
+
+        return metricas, aceleracao
+
+    # Evaluate each combination of hyperparameters on every fold and retrain the best one on the full training data
+    def fit(self, df):
+        metricas, aceleracao = self.avaliar_grade()
+
+        # Best combination (the evaluator tells if the metric is larger or smaller is better)
+        avaliadas = [i for i in range(len(metricas)) if metricas[i] is not None]
+        if len(avaliadas) == 0:
+            raise TempoEsgotado("The time budget ended before any combination of " + type(self.estimator).__name__ + " was evaluated")
+        escolher = builtins.max if self.evaluator.isLargerBetter() else builtins.min
+        melhor = escolher(avaliadas, key = lambda i: metricas[i])
+        func_verificar_prazo("the refit of " + type(self.estimator).__name__)
+        melhor_modelo = self.estimator.fit(df, self.estimatorParamMaps[melhor])
+
+        return ModeloValidacaoCruzada(melhor_modelo, metricas, self.estimatorParamMaps[melhor], aceleracao)
+
+# Folds of the training data, shared by all the regressors
+folds_treino = func_criar_folds(dados_treino)
+
+"""
+===========================================
+SUCCESSIVE HALVING / HYPERBAND SEARCH
+===========================================
+"""
+
+# The fixed grids are small and every point is fully cross-validated.
+# Hyperband samples many configurations from a search space, evaluates them with a small budget
+# (few trees or iterations, or a fraction of the training data) and promotes only the best ones to
+# larger budgets, up to the full training. Much larger search spaces fit in the same compute.
+# Set the environment variable PROJECT14_MOTOR_BUSCA=hyperband to use it instead of the grids
+# (or PROJECT14_MOTOR_BUSCA=tpe for the Bayesian optimizer below).
+motor_busca = os.environ.get('PROJECT14_MOTOR_BUSCA', 'grade')
+
+# Search spaces of the algorithms (declared by the candidates of the registry):
+# a list of values, or (type, lower, upper) with type 'int', 'float' or 'log'
+espacos_busca = {nome: candidato.espaco for nome, candidato in candidatos_regressores.items() if candidato.espaco is not None}
+
+# Budget of each algorithm: (resource, minimum, maximum)
+# The resource is the number of trees or iterations, or 'fracao_dados' (fraction of the training data)
+recursos_busca = {nome: candidato.recurso for nome, candidato in candidatos_regressores.items() if candidato.espaco is not None}
+
+# Function to sample a value from the domain of a hyperparameter
+def func_amostrar_valor(dominio, rng):
+    if isinstance(dominio, list):
+        return rng.choice(dominio)
+    tipo, inferior, superior = dominio
+    if tipo == 'int':
+        return rng.randint(inferior, superior)
+    if tipo == 'float':
+        return rng.uniform(inferior, superior)
+    if tipo == 'log':
+        return math.exp(rng.uniform(math.log(inferior), math.log(superior)))
+    raise ValueError("Unknown domain type: " + str(tipo) + ". Use 'int', 'float' or 'log'.")
+
+# Hyperband search on the shared folds (same interface as the CrossValidator of Spark)
+class BuscaHyperband:
+
+    def __init__(self, estimator, espaco, evaluator, folds, recurso, eta = 3, semente = 42, parallelism = None):
+        self.estimator = estimator
+        self.espaco = espaco
+        self.evaluator = evaluator
+        self.folds = folds
+        self.recurso = recurso
+        self.eta = eta
+        self.semente = semente
+        self.parallelism = parallelism
+
+    # ParamMap of a configuration with a budget r
+    def configurar(self, configuracao, r):
+        parametros = {self.estimator.getParam(nome): valor for nome, valor in configuracao.items()}
+        if self.recurso[0] != 'fracao_dados':
+            parametros[self.estimator.getParam(self.recurso[0])] = int(builtins.round(r))
+        return parametros
+
+    # Folds with a budget r (with the resource 'fracao_dados', a sample of the training data of each fold)
+    def folds_recurso(self, r):
+        if self.recurso[0] != 'fracao_dados' or r >= self.recurso[2]:
+            return self.folds
+        return [(treino_fold.sample(fraction = r / self.recurso[2], seed = self.semente), validacao_fold) for treino_fold, validacao_fold in self.folds]
+
+    # Sample up to n distinct configurations (small discrete spaces have fewer than n, and repeats would be
+    # cross-validated again for nothing)
+    def amostrar(self, n, rng, tentativas_por_configuracao = 10):
+        configuracoes, vistas = [], set()
+        for i in range(n * tentativas_por_configuracao):
+            if len(configuracoes) == n:
+                break
+            configuracao = {parametro: func_amostrar_valor(dominio, rng) for parametro, dominio in self.espaco.items()}
+            chave = tuple(sorted((parametro, str(valor)) for parametro, valor in configuracao.items()))
+            if chave not in vistas:
+                vistas.add(chave)
+                configuracoes.append(configuracao)
+        return configuracoes
+
+    # Cross-validated metric of each configuration with a budget r (the fits run in the thread pool)
+    def avaliar(self, configuracoes, r):
+        # (the combinations not evaluated because of the time budget get the worst possible metric)
+        validacao = ValidacaoCruzada(self.estimator, [self.configurar(c, r) for c in configuracoes], self.evaluator, self.folds_recurso(r), self.parallelism)
+        pior = -float('inf') if self.evaluator.isLargerBetter() else float('inf')
+        return [pior if metrica is None else metrica for metrica in validacao.avaliar_grade()[0]]
+
+    def fit(self, df):
+        nome, r_min, r_max = self.recurso
+        rng = random.Random(self.semente)
+        maior_melhor = self.evaluator.isLargerBetter()
+
+        # Number of brackets: each one trades the number of configurations for the initial budget
+        s_max = int(math.floor(math.log(float(r_max) / r_min, self.eta) + 1e-9))
+
+        melhor_metrica, melhor_configuracao, num_fits = None, None, 0
+        tempo_esgotado = False
+        for s in range(s_max, -1, -1):
+
+            # Near the deadline, the remaining brackets are skipped and we keep the best configuration found so far
+            if tempo_esgotado or (melhor_configuracao is not None and func_tempo_restante() is not None and func_tempo_restante() <= 0):
+                break
+
+            # Successive halving: n configurations with budget r, keeping the best 1 / eta at each round
+            n = int(math.ceil(float(s_max + 1) / (s + 1) * self.eta ** s))
+            r = r_max * self.eta ** (-s)
+            configuracoes = self.amostrar(n, rng)
+
+            for i in range(s + 1):
+
+                # A round that doesn't fit in the time budget ends the search (with the best configuration found so far)
+                try:
+                    metricas = self.avaliar(configuracoes, r * self.eta ** i)
+                except TempoEsgotado:
+                    tempo_esgotado = True
+                    break
+                num_fits += len(configuracoes) * len(self.folds)
+                ordem = sorted(range(len(configuracoes)), key = lambda j: metricas[j], reverse = maior_melhor)
+
+                # The last round uses the full budget, so its best configuration competes with the other brackets
+                if i == s:
+                    metrica = metricas[ordem[0]]
+                    if melhor_metrica is None or (metrica > melhor_metrica if maior_melhor else metrica < melhor_metrica):
+                        melhor_metrica, melhor_configuracao = metrica, configuracoes[ordem[0]]
+
+                configuracoes = [configuracoes[j] for j in ordem[:builtins.max(1, len(configuracoes) // self.eta)]]
+
+        if melhor_configuracao is None or math.isinf(melhor_metrica):
+            raise TempoEsgotado("The time budget ended before any configuration of " + type(self.estimator).__name__ + " was evaluated")
+        print("Hyperband: " + str(num_fits) + " fits, best configuration", melhor_configuracao, "with metric", melhor_metrica)
+
+        # Retrain the best configuration with the full budget on the full training data
+        melhores_parametros = self.configurar(melhor_configuracao, r_max)
+        func_verificar_prazo("the refit of " + type(self.estimator).__name__)
+        return ModeloValidacaoCruzada(self.estimator.fit(df, melhores_parametros), [melhor_metrica], melhores_parametros)
+
+"""
+===========================================
+BAYESIAN (TPE) HYPERPARAMETER OPTIMIZER
+===========================================
+"""
+
+# The grids grow exponentially with each new hyperparameter (maxDepth, stepSize, subsamplingRate...).
+# The Tree-structured Parzen Estimator (TPE) proposes each new configuration from the results of the previous trials:
+# the trials are split into the best ones (a fraction gamma) and the others, a density is estimated for each group,
+# and the candidate with the largest ratio between the density of the best trials and the density of the others is tried.
+# Set the environment variable PROJECT14_MOTOR_BUSCA=tpe to use it (the trials are limited by num_tentativas_tpe).
+
+# Maximum number of trials (and number of random trials before the model is used) of each algorithm
+num_tentativas_tpe = 20
+num_tentativas_iniciais_tpe = 5
+
+# Parzen estimator of a hyperparameter, fitted on the values of a group of trials
+class EstimadorParzen:
+
+    def __init__(self, dominio, valores):
+        self.dominio = dominio
+        self.categorico = isinstance(dominio, list)
+
+        if self.categorico:
+
+            # Count of each value, plus one for the prior
+            self.pesos = [1.0 + builtins.sum(1 for v in valores if v == opcao) for opcao in dominio]
+
+        else:
+
+            # Gaussian kernels on the values (in log scale for the 'log' domains), plus a uniform prior
+            self.tipo, inferior, superior = dominio
+            self.inferior, self.superior = self.escala(inferior), self.escala(superior)
+            self.pontos = [self.escala(v) for v in valores]
+            amplitude = self.superior - self.inferior
+            if len(self.pontos) > 1:
+                media = builtins.sum(self.pontos) / len(self.pontos)
+                desvio = math.sqrt(builtins.sum((p - media) ** 2 for p in self.pontos) / len(self.pontos))
+            else:
+                desvio = amplitude
+            self.largura = builtins.max(amplitude / 10.0, 1.06 * desvio * (len(self.pontos) + 1) ** (-0.2))
+
+    def escala(self, valor):
+        return math.log(valor) if self.tipo == 'log' else float(valor)
+
+    def valor(self, x):
+        if self.tipo == 'log':
+            return math.exp(x)
+        return int(builtins.round(x)) if self.tipo == 'int' else x
+
+    # Sample a value
+    def amostrar(self, rng):
+        if self.categorico:
+            return rng.choices(self.dominio, weights = self.pesos)[0]
+        if rng.random() < 1.0 / (len(self.pontos) + 1):
+            x = rng.uniform(self.inferior, self.superior)
+        else:
+            x = rng.gauss(rng.choice(self.pontos), self.largura)
+        return self.valor(builtins.min(builtins.max(x, self.inferior), self.superior))
+
+    # Density of a value
+    def densidade(self, valor):
+        if self.categorico:
+            return self.pesos[self.dominio.index(valor)] / builtins.sum(self.pesos)
+        x = self.escala(valor)
+        densidade = 1.0 / builtins.max(self.superior - self.inferior, 1e-12)
+        for p in self.pontos:
+            densidade += math.exp(-0.5 * ((x - p) / self.largura) ** 2) / (self.largura * math.sqrt(2 * math.pi))
+        return densidade / (len(self.pontos) + 1)
+
+# TPE search on the shared folds (same interface as the CrossValidator of Spark)
+class BuscaTPE:
+
+    def __init__(self, estimator, espaco, evaluator, folds, num_tentativas = num_tentativas_tpe, num_iniciais = num_tentativas_iniciais_tpe,
+                 gamma = 0.25, num_candidatos = 24, semente = 42, parallelism = None):
+        self.estimator = estimator
+        self.espaco = espaco
+        self.evaluator = evaluator
+        self.folds = folds
+        self.num_tentativas = num_tentativas
+        self.num_iniciais = num_iniciais
+        self.gamma = gamma
+        self.num_candidatos = num_candidatos
+        self.semente = semente
+        self.parallelism = parallelism
+
+    # Cross-validated metric of a configuration (the fits of the folds run in the thread pool)
+    def avaliar(self, configuracao):
+        parametros = {self.estimator.getParam(nome): valor for nome, valor in configuracao.items()}
+        return ValidacaoCruzada(self.estimator, [parametros], self.evaluator, self.folds, self.parallelism).avaliar_grade()[0][0]
+
+    # Key of a configuration (the metric of a configuration already tried is reused)
+    def chave(self, configuracao):
+        return tuple(sorted((parametro, str(valor)) for parametro, valor in configuracao.items()))
+
+    # Number of distinct configurations of the space (None if it has a continuous dimension)
+    def tamanho_espaco(self):
+        tamanho = 1
+        for dominio in self.espaco.values():
+            if isinstance(dominio, list):
+                tamanho *= len(set(str(valor) for valor in dominio))
+            elif dominio[0] == 'int':
+                tamanho *= dominio[2] - dominio[1] + 1
+            else:
+                return None
+        return tamanho
+
+    # Propose the next configuration from the previous trials
+    def propor(self, tentativas, rng):
+
+        # Random trials until there are enough results to fit the estimators
+        if len(tentativas) < self.num_iniciais:
+            return {parametro: func_amostrar_valor(dominio, rng) for parametro, dominio in self.espaco.items()}
+
+        # Split the trials into the best ones and the others
+        ordenadas = sorted(tentativas, key = lambda t: t[1], reverse = self.evaluator.isLargerBetter())
+        num_bons = builtins.max(1, int(math.ceil(self.gamma * len(ordenadas))))
+        bons, ruins = ordenadas[:num_bons], ordenadas[num_bons:]
+
+        # Estimators of each hyperparameter (the hyperparameters are treated as independent)
+        estimadores = {parametro: (EstimadorParzen(dominio, [t[0][parametro] for t in bons]), EstimadorParzen(dominio, [t[0][parametro] for t in ruins]))
+                       for parametro, dominio in self.espaco.items()}
+
+        # Sample candidates from the density of the best trials and keep the one with the largest ratio l(x) / g(x)
+        melhor, melhor_razao = None, None
+        for i in range(self.num_candidatos):
+            candidato = {parametro: bom.amostrar(rng) for parametro, (bom, ruim) in estimadores.items()}
+            razao = 1.0
+            for parametro, (bom, ruim) in estimadores.items():
+                razao *= bom.densidade(candidato[parametro]) / builtins.max(ruim.densidade(candidato[parametro]), 1e-12)
+            if melhor_razao is None or razao > melhor_razao:
+                melhor, melhor_razao = candidato, razao
+        return melhor
+
+    def fit(self, df):
+        rng = random.Random(self.semente)
+
+        # Sequential trials: each one uses the results of the previous ones
+        # (metrics by configuration, so a configuration is cross-validated only once)
+        tentativas, metricas = [], {}
+        tamanho_espaco = self.tamanho_espaco()
+        for i in range(self.num_tentativas):
+
+            # A finite space already tried in full ends the search
+            if tamanho_espaco is not None and len(metricas) >= tamanho_espaco:
+                break
+
+            # Near the deadline, we stop the trials and keep the best configuration found so far
+            if len(tentativas) > 0 and func_tempo_restante() is not None and func_tempo_restante() <= 0:
+                break
+
+            # Propose a configuration not tried yet (after num_candidatos repeated proposals, the repeat is kept)
+            for j in range(self.num_candidatos):
+                configuracao = self.propor(tentativas, rng)
+                if self.chave(configuracao) not in metricas:
+                    break
+
+            # A repeated configuration reuses its metric, a new one is cross-validated
+            # (a trial that doesn't fit in the time budget ends the search, with the best trial found so far)
+            if self.chave(configuracao) in metricas:
+                metrica = metricas[self.chave(configuracao)]
+            else:
+                try:
+                    metrica = self.avaliar(configuracao)
+                except TempoEsgotado:
+                    break
+                if metrica is None:
+                    break
+                metricas[self.chave(configuracao)] = metrica
+            tentativas.append((configuracao, metrica))
+
+        if len(tentativas) == 0:
+            raise TempoEsgotado("The time budget ended before any trial of " + type(self.estimator).__name__ + " was evaluated")
+
+        # Best trial
+        escolher = builtins.max if self.evaluator.isLargerBetter() else builtins.min
+        melhor_configuracao, melhor_metrica = escolher(tentativas, key = lambda t: t[1])
+        print("TPE: " + str(len(tentativas)) + " trials (" + str(len(metricas)) + " distinct configurations cross-validated), best configuration", melhor_configuracao, "with metric", melhor_metrica)
+
+        # Retrain the best configuration on the full training data
+        melhores_parametros = {self.estimator.getParam(nome): valor for nome, valor in melhor_configuracao.items()}
+        func_verificar_prazo("the refit of " + type(self.estimator).__name__)
+        return ModeloValidacaoCruzada(self.estimator.fit(df, melhores_parametros), [t[1] for t in tentativas], melhores_parametros)
+
+# Search space of the TPE: the space of the algorithm plus its number of trees or iterations
+def func_espaco_tpe(nome):
+    espaco = dict(espacos_busca[nome])
+    recurso, minimo, maximo = recursos_busca[nome]
+    if recurso != 'fracao_dados':
+        espaco[recurso] = ('int', minimo, maximo)
+    return espaco
+
+# Function to create the hyperparameter search of an algorithm: cross validation of the grid,
+# or Hyperband or TPE on the search space of the algorithm (when there is one)
+def func_criar_busca(nome, estimador, grade, avaliador):
+    if motor_busca == 'hyperband' and nome in espacos_busca:
+        return BuscaHyperband(estimador, espacos_busca[nome], avaliador, folds_treino, recursos_busca[nome])
+    if motor_busca == 'tpe' and nome in espacos_busca:
+        return BuscaTPE(estimador, func_espaco_tpe(nome), avaliador, folds_treino)
+    return ValidacaoCruzada(estimator = estimador, estimatorParamMaps = grade, evaluator = avaliador, folds = folds_treino)
+
+"""
+===========================================
+RESULTS LEDGER
+===========================================
+"""
+
+# The summary of each model was a one-row Spark DataFrame, with the metrics cut as strings and unioned into the
+# results table: several jobs and plan nodes for a handful of rows. The results are kept in the driver instead,
+# with numeric metrics, the training time and the chosen hyperparameters of each model, and written in one go
+# as JSON, CSV or Parquet (by the extension of the file).
+# Set the environment variable PROJECT14_RESULTADOS to the file where the results are exported.
+caminho_resultados = os.environ.get('PROJECT14_RESULTADOS')
+
+# Results of the models (one line per model; the regressors train concurrently, so the lines are added under a lock)
+class RegistroResultados:
+
+    colunas = ['Regressor', 'RMSE', 'R2', 'MAE', 'MAPE', 'Erro_Maximo', 'Iteracoes', 'Tempo_Segundos', 'Parametros']
+
+    def __init__(self):
+        self.linhas = []
+        self.lock = threading.Lock()
+
+    # Add the line of a model
+    def registrar(self, linha):
+        with self.lock:
+            self.linhas.append({coluna: linha.get(coluna) for coluna in self.colunas})
+
+    # Lines ordered by a metric (the missing values go last)
+    def ordenadas(self, metrica = 'RMSE', maior_melhor = False):
+        with self.lock:
+            linhas = list(self.linhas)
+        return sorted(linhas, key = lambda linha: (linha[metrica] is None, -linha[metrica] if maior_melhor and linha[metrica] is not None else linha[metrica]))
+
+    # Print the leaderboard
+    def mostrar(self, metrica = 'RMSE', maior_melhor = False):
+        def formatar(valor):
+            if isinstance(valor, float):
+                return '{:.4f}'.format(valor)
+            return 'N/A' if valor is None else str(valor)
+        tabela = [self.colunas[:-1]] + [[formatar(linha[coluna]) for coluna in self.colunas[:-1]] for linha in self.ordenadas(metrica, maior_melhor)]
+        larguras = [builtins.max(len(linha[j]) for linha in tabela) for j in range(len(tabela[0]))]
+        for linha in tabela:
+            print(' | '.join(valor.ljust(largura) for valor, largura in zip(linha, larguras)))
+
+    # Export the results to a JSON, CSV or Parquet file (by the extension)
+    def exportar(self, caminho):
+        linhas = self.ordenadas()
+        if os.path.dirname(caminho):
+            os.makedirs(os.path.dirname(caminho), exist_ok = True)
+        if caminho.endswith('.json'):
+            with open(caminho, 'w') as arquivo:
+                json.dump(linhas, arquivo, indent = 2)
+        elif caminho.endswith('.csv'):
+            with open(caminho, 'w', newline = '') as arquivo:
+                escritor = csv.DictWriter(arquivo, fieldnames = self.colunas)
+                escritor.writeheader()
+                escritor.writerows([dict(linha, Parametros = json.dumps(linha['Parametros'])) for linha in linhas])
+        elif caminho.endswith('.parquet'):
+            import pandas
+            pandas.DataFrame([dict(linha, Parametros = json.dumps(linha['Parametros'])) for linha in linhas], columns = self.colunas).to_parquet(caminho, index = False)
+        else:
+            raise ValueError("Unknown format of the results file: " + caminho)
+        print("Results exported to", caminho)
+
+# Function to create the line of a model in the results ledger from its test metrics and its search
+def func_linha_resultado(nome, metricas, modelo):
+    parametros = getattr(modelo, 'melhores_parametros', None) or {}
+    return {'Regressor': nome,
+            'RMSE': metricas['rmse'],
+            'R2': metricas['r2'],
+            'MAE': metricas['mae'],
+            'MAPE': metricas['mape'],
+            'Erro_Maximo': metricas['erro_maximo'],
+            'Iteracoes': iteracoes_modelos.get(nome),
+            'Parametros': {parametro.name: valor for parametro, valor in parametros.items()}}
 
 """
 ===========================================
@@ -237,232 +2146,90 @@ MÓDULO AUTOML (AUTOMATED MACHINE LEARNING)
 # Our function will create, train and evaluate each of them with different combinations of hyperparameters.
 # And then we'll choose the best performing model.
 
-# Machine Learning module
-def func_modulo_ml(algoritmo_regressao):
-    # Function to get the type of the regression algorithm and create the object instance
-    # We will use this to automate our process
-    def func_tipo_algo(algo_regressao):
-        algoritmo = algo_regressao
-        tipo_algo = type(algoritmo).__name__
-        return tipo_algo
-    
-    # Apply the previous function
-    tipo_algo = func_tipo_algo(algoritmo_regressao)
-
-    # If the algorithm is Linear Regression, enter this block if
-    if tipo_algo == "LinearRegression":
-        
-        # We train the first version of the model without cross-validation
-        modelo = regressor.fit(dados_treino)
-        
-        # Model metrics
-        print('\033[1m' + "Linear Regression Model Without Cross Validation:" + '\033[0m')
+# RegressionEvaluator computes one metric per call, so each metric is a separate job over the predictions.
+# The test metrics of each model (RMSE, R2, MAE, MAPE and maximum error) are computed together in one aggregation.
+def func_metricas_regressao(modelo, df, labelCol = 'label', predictionCol = 'prediction'):
+    func_verificar_prazo("the evaluation of " + type(modelo).__name__)
+    previsoes = modelo.transform(df)
+    erro = col(predictionCol) - col(labelCol)
+    linha = previsoes.agg(count(lit(1)).alias('n'),
+                          sum(erro * erro).alias('soma_quadrados'),
+                          sum(abs(erro)).alias('soma_absolutos'),
+                          avg(when(col(labelCol) != 0, abs(erro / col(labelCol)))).alias('mape'),
+                          max(abs(erro)).alias('erro_maximo'),
+                          var_pop(col(labelCol)).alias('variancia')).first()
+
+    # R2 = 1 - SSE / SST (the total sum of squares is n times the population variance of the label)
+    n = linha['n']
+    return {'rmse': math.sqrt(linha['soma_quadrados'] / n),
+            'r2': 1 - linha['soma_quadrados'] / (n * linha['variancia']) if linha['variancia'] > 0 else float('nan'),
+            'mae': linha['soma_absolutos'] / n,
+            'mape': linha['mape'],
+            'erro_maximo': linha['erro_maximo']}
+
+# Function to print the test metrics of a model
+def func_imprimir_metricas(metricas):
+    print('RMSE in Test:', metricas['rmse'])
+    print('R2 Coefficient in Test:', metricas['r2'])
+    print('MAE in Test:', metricas['mae'])
+    print('MAPE in Test:', metricas['mape'])
+    print('Maximum Error in Test:', metricas['erro_maximo'])
+    print("")
+
+# Best model of each algorithm and its RMSE in test (filled as the algorithms finish)
+melhores_modelos = {}
+rmse_teste_modelos = {}
+
+# Machine Learning module: search the hyperparameters of a candidate of the registry, evaluate its best model
+# in test and return its line of the results ledger
+def func_modulo_ml(candidato):
+    nome = candidato.nome
+
+    # New estimator of the candidate
+    algoritmo_regressao = candidato.criar_estimador()
+    if candidato.configurar is not None:
+        candidato.configurar(algoritmo_regressao)
+
+    # Version of the model without cross validation (for reference)
+    if candidato.modelo_base:
+        func_verificar_prazo("the training of " + nome)
+        modelo = algoritmo_regressao.fit(gerenciador_cache.obter('dados_treino'))
+
+        print('\033[1m' + candidato.titulo + " Without Cross Validation:" + '\033[0m')
         print("")
-        
-        # Evaluate the model with test data
-        resultado_teste = modelo.evaluate(dados_teste)
 
-        # Print model error metrics with test data
-        print("RMSE in Test: {}".format(resultado_teste.rootMeanSquaredError))
-        print("R2 Coefficient in Test: {}".format(resultado_teste.r2))
-        print("")
-        
-        # Now let's create the second version of the model with the same algorithm, but using cross-validation
-        
-        # Prepare the hyperparameter grid
-        paramGrid = (ParamGridBuilder().addGrid(regressor.regParam, [0.1, 0.01]).build())
-        
-        # Create the evaluators
-        eval_rmse = RegressionEvaluator(metricName = "rmse")
-        eval_r2 = RegressionEvaluator(metricName = "r2")
-
-        # Create the Cross Validator
-        crossval = CrossValidator(estimator = regressor,
-                                  estimatorParamMaps = paramGrid,
-                                  evaluator = eval_rmse,
-                                  numFolds = 3) 
-        
-        print('\033[1m' + "Linear Regression Model With Cross Validation:" + '\033[0m')
-        print("")
-        
-        # Train the model with cross validation
-        modelo = crossval.fit(dados_treino)
-        
-        # Save the best version 2 model
-        global LR_BestModel 
-        LR_BestModel = modelo.bestModel
-                
-        # Predictions with test data
-        previsoes = LR_BestModel.transform(dados_teste)
-        
-        # Evaluation of the best model
-        resultado_teste_rmse = eval_rmse.evaluate(previsoes)
-        print('RMSE in Test:', resultado_teste_rmse)
-        
-        resultado_teste_r2 = eval_r2.evaluate(previsoes)
-        print('R2 Coefficient in Test:', resultado_teste_r2)
-        print("")
-    
-        # List of columns to put in the summary dataframe
-        columns = ['Regressor', 'Resultado_RMSE', 'Resultado_R2']
-        
-        # Format the results and create the dataframe
-        
-        # Format metrics and algorithm name
-        rmse_str = [str(resultado_teste_rmse)] 
-        r2_str = [str(resultado_teste_r2)] 
-        tipo_algo = [tipo_algo] 
-        
-        # create dataframe
-        df_resultado = spark.createDataFrame(zip(tipo_algo, rmse_str, r2_str), schema = columns)
-        
-        # Write the results to the dataframe
-        df_resultado = df_resultado.withColumn('Result_RMSE', df_resultado.Resultado_RMSE.substr(0, 5))
-        df_resultado = df_resultado.withColumn('Result_R2', df_resultado.Resultado_R2.substr(0, 5))
-        
-        return df_resultado
+        # Evaluate the model with test data and print its error metrics
+        func_imprimir_metricas(func_metricas_regressao(modelo, gerenciador_cache.obter('dados_teste')))
 
-    else:
-        
-        # Check if the algorithm is the Decision Tree and create the hyperparameter grid
-        if tipo_algo in("DecisionTreeRegressor"):
-            paramGrid = (ParamGridBuilder().addGrid(regressor.maxBins, [10, 20, 40]).build())
+    # Create the evaluator of the cross validation
+    eval_rmse = RegressionEvaluator(metricName = "rmse")
 
-        # Check if the algorithm is Random Forest and create the hyperparameter grid
-        if tipo_algo in("RandomForestRegressor"):
-            paramGrid = (ParamGridBuilder().addGrid(regressor.numTrees, [5, 20]).build())
+    # Prepara o Cross Validator (on the shared folds)
+    # (or the Hyperband or TPE search, depending on motor_busca)
+    crossval = func_criar_busca(nome, algoritmo_regressao, candidato.grade(algoritmo_regressao), eval_rmse)
 
-        # Check if the algorithm is GBT and create the hyperparameter grid
-        if tipo_algo in("GBTRegressor"):
-            paramGrid = (ParamGridBuilder().addGrid(regressor.maxBins, [10, 20]).addGrid(regressor.maxIter, [10, 15]).build())
-            
-        # Check if the algorithm is Isotonic
-        if tipo_algo in("IsotonicRegression"):
-            paramGrid = (ParamGridBuilder().addGrid(regressor.isotonic, [True, False]).build())
+    # Train the model using cross validation
+    modelo = crossval.fit(gerenciador_cache.obter('dados_treino'))
 
-        # Create the evaluators
-        eval_rmse = RegressionEvaluator(metricName = "rmse")
-        eval_r2 = RegressionEvaluator(metricName = "r2")
-        
-        # Prepara o Cross Validator
-        crossval = CrossValidator(estimator = regressor, estimatorParamMaps = paramGrid, evaluator = eval_rmse, numFolds = 3)
-        
-        # Train the model using cross validation
-        modelo = crossval.fit(dados_treino)
-        
-        # Extract the best model
-        BestModel = modelo.bestModel
+    # Extract the best model
+    BestModel = modelo.bestModel
+    melhores_modelos[nome] = BestModel
 
-        # Summary of each model
-        # Model metrics
-        if tipo_algo in("DecisionTreeRegressor"):
-            
-            # Global Variable
-            global DT_BestModel 
-            DT_BestModel = modelo.bestModel
-            
-            # Predictions with test data
-            previsoes_DT = DT_BestModel.transform(dados_teste)
-            
-            print('\033[1m' + "Decision Tree Model With Cross Validation:" + '\033[0m')
-            print(" ")
-            
-            # Model evaluation
-            resultado_teste_rmse = eval_rmse.evaluate(previsoes_DT)
-            print('RMSE in Test:', resultado_teste_rmse)
-        
-            resultado_teste_r2 = eval_r2.evaluate(previsoes_DT)
-            print('R2 Coefficient in Test:', resultado_teste_r2)
-            print("")
-        
-        # Model metrics
-        if tipo_algo in("RandomForestRegressor"):
-            
-            # global variable
-            global RF_BestModel 
-            RF_BestModel = modelo.bestModel
-            
-            # Predictions with test data
-            previsoes_RF = RF_BestModel.transform(dados_teste)
-            
-            print('\033[1m' + "RandomForest Model With Cross Validation:" + '\033[0m')
-            print(" ")
-            
-            # Model evaluation
-            resultado_teste_rmse = eval_rmse.evaluate(previsoes_RF)
-            print('RMSE in Test:', resultado_teste_rmse)
-        
-            resultado_teste_r2 = eval_r2.evaluate(previsoes_RF)
-            print('R2 Coefficient in Test:', resultado_teste_r2)
-            print("")
-        
-        # Model metrics
-        if tipo_algo in("GBTRegressor"):
+    # Number of iterations actually used (for the candidates with early stopping)
+    if candidato.iteracoes is not None:
+        iteracoes_modelos[nome] = candidato.iteracoes(BestModel)
+        print('Iterations used:', iteracoes_modelos[nome], 'of maxIter =', BestModel.getOrDefault('maxIter'))
 
-            # global variable
-            global GBT_BestModel 
-            GBT_BestModel = modelo.bestModel
-            
-            # Predictions with test data
-            previsoes_GBT = GBT_BestModel.transform(dados_teste)
-            
-            print('\033[1m' + "Gradient-Boosted Tree (GBT) Model With Cross Validation:" + '\033[0m')
-            print(" ")
-            
-            # Model evaluation
-            resultado_teste_rmse = eval_rmse.evaluate(previsoes_GBT)
-            print('RMSE in Test:', resultado_teste_rmse)
-        
-            resultado_teste_r2 = eval_r2.evaluate(previsoes_GBT)
-            print('R2 Coefficient in Test:', resultado_teste_r2)
-            print("")
-            
-        # Model metrics
-        if tipo_algo in("IsotonicRegression"):
+    print('\033[1m' + candidato.titulo + " With Cross Validation:" + '\033[0m')
+    print(" ")
 
-            # global variable
-            global ISO_BestModel 
-            ISO_BestModel = modelo.bestModel
-            
-            # Predictions with test data
-            previsoes_ISO = ISO_BestModel.transform(dados_teste)
-            
-            print('\033[1m' + "Isotonic Model With Cross Validation:" + '\033[0m')
-            print(" ")
-            
-            # Avaliação do modelo
-            resultado_teste_rmse = eval_rmse.evaluate(previsoes_ISO)
-            print('RMSE in Test:', resultado_teste_rmse)
-        
-            resultado_teste_r2 = eval_r2.evaluate(previsoes_ISO)
-            print('R2 Coefficient in Test:', resultado_teste_r2)
-            print("")
-                    
-        # List of columns to put in the summary dataframe
-        columns = ['Regressor', 'Resultado_RMSE', 'Resultado_R2']
-        
-        # Make predictions with test data
-        previsoes = modelo.transform(dados_teste)
-        
-        # Evaluate the model to save the result
-        eval_rmse = RegressionEvaluator(metricName = "rmse")
-        rmse = eval_rmse.evaluate(previsoes)
-        rmse_str = [str(rmse)]
-        
-        eval_r2 = RegressionEvaluator(metricName = "r2")
-        r2 = eval_r2.evaluate(previsoes)
-        r2_str = [str(r2)]
-         
-        tipo_algo = [tipo_algo] 
-        
-        # Create the dataframe
-        df_resultado = spark.createDataFrame(zip(tipo_algo, rmse_str, r2_str), schema = columns)
-        
-        # Write the result to the dataframe
-        df_resultado = df_resultado.withColumn('Resultado_RMSE', df_resultado.Resultado_RMSE.substr(0, 5))
-        df_resultado = df_resultado.withColumn('Resultado_R2', df_resultado.Resultado_R2.substr(0, 5))
-        
-        return df_resultado
+    # Model evaluation (all the metrics in one aggregation over the predictions with test data)
+    metricas_teste = func_metricas_regressao(BestModel, gerenciador_cache.obter('dados_teste'))
+    func_imprimir_metricas(metricas_teste)
+
+    # Save the result and return the line of the results ledger
+    rmse_teste_modelos[nome] = metricas_teste['rmse']
+    return func_linha_resultado(nome, metricas_teste, modelo)
 
 
 """
@@ -471,32 +2238,94 @@ RUN MACHINE LEARNING MODULE
 ============================
 """
 
-# List of algorithms
-regressores = [LinearRegression(), DecisionTreeRegressor(), RandomForestRegressor(), GBTRegressor(), IsotonicRegression()]
-
-# List of columns and values
-colunas = ['Regressor', 'Resultado_RMSE', 'Resultado_R2']
-valores = [("N/A", "N/A", "N/A")]
-
-# Prepare the summary table
-df_resultados_treinamento = spark.createDataFrame(valores, colunas)
+# Candidates of the registry (the cheap ones first)
+regressores = func_ordenar_candidatos(candidatos_regressores.values())
+
+# Results ledger of the run
+registro_resultados = RegistroResultados()
+
+# Train a regressor in its own scheduler pool and job group (None if it doesn't fit in the time budget)
+def func_treinar_no_pool(regressor):
+    nome = regressor.nome
+    sc.setLocalProperty("spark.scheduler.pool", nome)
+    sc.setJobGroup(nome, "AutoML - " + nome, interruptOnCancel = True)
+    inicio = time.perf_counter()
+    with lock_regressores:
+        regressores_em_treino[nome] = regressor.peso_pool
+    try:
+        resultado = func_modulo_ml(regressor)
+    except Exception as erro:
+
+        # After the deadline, the errors come from the cancelled jobs or from the time budget
+        restante = func_tempo_restante()
+        if restante is None or (restante > 0 and not isinstance(erro, TempoEsgotado)):
+            raise
+        print("\n" + nome + " skipped (time budget):", erro)
+        return None
+    finally:
+        with lock_regressores:
+            regressores_em_treino.pop(nome, None)
+    resultado['Tempo_Segundos'] = time.perf_counter() - inicio
+    print(nome + " finished in", resultado['Tempo_Segundos'], "seconds")
+    return resultado
+
+# Train all the regressors concurrently from a thread pool (the results keep the order of the list)
+# With a time budget, the regressors still training at the deadline are cancelled and left out of the results
+def func_executar_automl(regressores):
+    global prazo_automl
+    inicio = time.perf_counter()
+    if tempo_limite_automl is not None:
+        prazo_automl = inicio + tempo_limite_automl
+
+    pool = ThreadPoolExecutor(max_workers = len(regressores))
+    futuros = [pool.submit(inheritable_thread_target(func_treinar_no_pool), regressor) for regressor in regressores]
+    concluidos, pendentes = wait(futuros, timeout = tempo_limite_automl)
+
+    # Cancel the jobs of the regressors still training and wait for their threads to stop
+    # (the cancellation is repeated until the threads stop, in case a thread submitted a job after it)
+    for regressor, futuro in zip(regressores, futuros):
+        if futuro in pendentes:
+            print("\nDeadline reached: cancelling " + regressor.nome)
+    while len(pendentes) != 0:
+        for regressor, futuro in zip(regressores, futuros):
+            if futuro in pendentes:
+                sc.cancelJobGroup(regressor.nome)
+        concluidos, pendentes = wait(pendentes, timeout = 1)
+    pool.shutdown(wait = True)
+
+    print("\nAutoML finished in", time.perf_counter() - inicio, "seconds")
+    return [futuro.result() for futuro in futuros]
 
 # training loop
-for regressor in regressores:
+for resultado_modelo in func_executar_automl(regressores):
     
-    # For each regressor get the result
-    resultado_modelo = func_modulo_ml(regressor)
-    
-    # Save the results
-    df_resultados_treinamento = df_resultados_treinamento.union(resultado_modelo)
-
-# Return lines other than N/A
-df_resultados_treinamento = df_resultados_treinamento.where("Regressor!='N/A'")
-
-# Print
-df_resultados_treinamento.show(10, False)
-
-# The GBT model showed the best overall performance and will be used in production.
+    # Save the results (the regressors skipped by the time budget have no result)
+    if resultado_modelo is not None:
+        registro_resultados.registrar(resultado_modelo)
+
+# Best model found (lowest RMSE in test among the algorithms that finished)
+# (None when no algorithm finished within the time budget: the results are still reported below)
+melhor_modelo = None
+if len(rmse_teste_modelos) != 0:
+    nome_melhor_modelo = builtins.min(rmse_teste_modelos, key = rmse_teste_modelos.get)
+    melhor_modelo = melhores_modelos[nome_melhor_modelo]
+    print("\nBest model:", nome_melhor_modelo, "with RMSE in test =", rmse_teste_modelos[nome_melhor_modelo])
+else:
+    print("\nNo algorithm finished within the time budget: there is no best model to score new data")
+
+# Cache hit rate and memory in use (before the training and test data are released)
+gerenciador_cache.relatorio()
+
+# The training and the evaluation are done, so the training and test data are released
+gerenciador_cache.concluir('treino')
+gerenciador_cache.concluir('avaliacao')
+
+# Print the leaderboard (no Spark job) and export the results
+registro_resultados.mostrar()
+if caminho_resultados is not None:
+    registro_resultados.exportar(caminho_resultados)
+
+# The model with the best overall performance (GBT in our runs) will be used in production.
 # Making predictions with the trained model
 # To make predictions with the trained model, let's prepare a record with new data.
 # - Cement: 540
@@ -508,39 +2337,29 @@ df_resultados_treinamento.show(10, False)
 # - Fine Aggregate: 676
 # - Age: 28
 
-# List of input values
-values = [(540,0.0,0.0,162,2.5,1040,676,28)]
-
-# Column names
-column_names = dados.columns
-column_names = column_names[0:8]
-
-# Bind values to column names
-novos_dados = spark.createDataFrame(values, column_names)
-
-# We apply the same transformation applied in the data preparation to the age column.
-novos_dados = novos_dados.withColumn("age", log("age") +1)
+# Skipped when no model finished within the time budget
+if melhor_modelo is not None:
 
-# Attribute list
-lista_atributos = ["cement", "slag", "flyash", "water", "superplasticizer", "coarseaggregate", "fineaggregate", "age"]
+    # List of input values
+    values = [(540,0.0,0.0,162,2.5,1040,676,28)]
 
-# Create the vectorizer
-assembler = VectorAssembler(inputCols = lista_atributos, outputCol = 'features')
+    # Column names
+    column_names = variaveis_entrada
 
-# Convert data to vector
-novos_dados = assembler.transform(novos_dados).select('features')
+    # Bind values to column names
+    novos_dados = spark.createDataFrame(values, column_names)
 
-# Standardize the data (same transformation applied to training data)
-novos_dados_scaled = scalerModel.transform(novos_dados)
+    # Load the preprocessing model saved in the data preparation
+    modelo_prep_producao = ModeloPrep.load(caminho_modelo_prep)
 
-# Select the resulting column
-novos_dados_final = novos_dados_scaled.select('scaledFeatures')
+    # Apply the same preparation applied to the training data (outlier treatment, vectorization and standardization)
+    novos_dados_final = modelo_prep_producao.transform(novos_dados)
 
-# Rename the column (MLlib requirement)
-novos_dados_final = novos_dados_final.withColumnRenamed('scaledFeatures','features')
+    # Predictions with new data using the best performing model
+    previsoes_novos_dados = melhor_modelo.transform(novos_dados_final)
 
-# Predictions with new data using the best performing model
-previsoes_novos_dados = GBT_BestModel.transform(novos_dados_final)
+    # Result
+    previsoes_novos_dados.show()
 
-# Result
-previsoes_novos_dados.show()
\ No newline at end of file
+# Jobs saved by the quiet mode (if enabled)
+func_relatorio_modo_silencioso()